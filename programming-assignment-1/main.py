@@ -2,7 +2,25 @@
 @Author: Jack McGowan
 @Date: 01/23/2023
 """
+import hashlib
+import importlib.util
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
 import unittest
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 class Instruction:
@@ -13,20 +31,57 @@ class Instruction:
     immed = int()
 
 
+class DecodedInstruction:
+    # Pre-decoded form of an instruction word: the handler is already bound to
+    # the Cpu and the operands are packed in the order the handler takes them
+    __slots__ = ('opcode', 'handler', 'args')
+
+    def __init__(self, opcode: int, handler, args: tuple):
+        self.opcode = opcode
+        self.handler = handler
+        self.args = args
+
+
+class TranslatedBlock:
+    # A straight-line run of instructions compiled into one Python function.
+    # run(regs, mem, invalidate) executes the whole block and returns the next pc
+    __slots__ = ('start', 'length', 'last_opcode', 'run', 'source')
+
+    def __init__(self, start: int, length: int, last_opcode: int, run, source: str):
+        self.start = start
+        self.length = length
+        self.last_opcode = last_opcode
+        self.run = run
+        self.source = source
+
+
 class Cpu:
     MEM_SIZE = 65536
     NUM_REGISTERS = 16
+    MAX_BLOCK_LENGTH = 64
+    # Memory is tracked for checkpoints in pages of 2^PAGE_BITS words
+    PAGE_BITS = 8
+
+    # None for unbounded Python ints, CompactCpu wraps registers to 32 bits
+    WORD_MASK = None
 
     pc = int()
     next_pc = int()
-    mem = [int()] * MEM_SIZE
-    regs = [int()] * NUM_REGISTERS
+    mem = None
+    regs = None
 
     def __init__(self):
         self.pc = int()
         self.next_pc = int()
         self.mem = [int()] * self.MEM_SIZE
         self.regs = [int()] * self.NUM_REGISTERS
+        # pc -> DecodedInstruction, entries are dropped when sw overwrites them
+        self.decoded = {}
+        # block start pc -> TranslatedBlock, and address -> starts of the blocks covering it
+        self.blocks = {}
+        self.block_map = {}
+        # pages written since the last checkpoint
+        self.dirty_pages = set()
 
     def fetch(self) -> int:
         instruction = self.mem[self.pc]
@@ -50,6 +105,181 @@ class Cpu:
 
         return parsed
 
+    def predecode(self, i: Instruction) -> DecodedInstruction:
+        op = i.opcode
+        if op == 1:
+            return DecodedInstruction(op, self.add, (i.Rd, i.Rs1, i.Rs2))
+        elif op == 2:
+            return DecodedInstruction(op, self.addi, (i.Rd, i.Rs1, i.immed))
+        elif op == 3:
+            return DecodedInstruction(op, self.beq, (i.Rs1, i.Rs2, i.immed))
+        elif op == 4:
+            return DecodedInstruction(op, self.jal, (i.Rd, i.immed))
+        elif op == 5:
+            return DecodedInstruction(op, self.lw, (i.Rd, i.Rs1, i.immed))
+        elif op == 6:
+            return DecodedInstruction(op, self.sw, (i.Rs1, i.Rs2, i.immed))
+        elif op == 7:
+            return DecodedInstruction(op, self.rtrn, ())
+        else:
+            return DecodedInstruction(op, self.noop, ())
+
+    def fetch_decoded(self) -> DecodedInstruction:
+        decoded = self.decoded.get(self.pc)
+        if decoded is None:
+            decoded = self.predecode(self.decode(self.fetch()))
+            self.decoded[self.pc] = decoded
+        return decoded
+
+    def exec_decoded(self, d: DecodedInstruction) -> None:
+        d.handler(*d.args)
+
+        self.pc = self.next_pc % self.MEM_SIZE
+        self.next_pc = self.pc + 1
+
+    # Cached equivalent of fetch -> decode -> exec, returns the executed opcode
+    def step(self) -> int:
+        d = self.fetch_decoded()
+        self.exec_decoded(d)
+        return d.opcode
+
+    # Must be called after writing self.mem directly (outside of sw),
+    # drops both the decoded instructions and the translated blocks
+    def flush_decoded(self) -> None:
+        self.decoded.clear()
+        self.blocks.clear()
+        self.block_map.clear()
+
+    def invalidate(self, address: int) -> None:
+        self.dirty_pages.add(address >> self.PAGE_BITS)
+        self.decoded.pop(address, None)
+        for start in self.block_map.pop(address, ()):
+            self.blocks.pop(start, None)
+
+    def translate_block(self, start: int) -> TranslatedBlock:
+        # Blocks end at beq, jal, rtrn or sw (so a store can invalidate the
+        # code that follows it before that code runs)
+        MAX_4_BIT = 15
+        MAX_16_BIT = 65_535
+
+        body = []
+        used = set()
+        written = set()
+        pc = start
+        length = 0
+        op = 0
+        next_pc = None
+        wrap = '' if self.WORD_MASK is None else f' & {self.WORD_MASK}'
+
+        while next_pc is None:
+            instruction = self.mem[pc]
+            op = (instruction >> 28) & MAX_4_BIT
+            rd = (instruction >> 24) & MAX_4_BIT
+            rs1 = (instruction >> 20) & MAX_4_BIT
+            rs2 = (instruction >> 16) & MAX_4_BIT
+            immed = instruction & MAX_16_BIT
+            fall = (pc + 1) % self.MEM_SIZE
+            length += 1
+
+            if op == 1:
+                body.append(f'r{rd} = r{rs1} + r{rs2}{wrap}')
+                used.update((rd, rs1, rs2))
+                written.add(rd)
+            elif op == 2:
+                body.append(f'r{rd} = r{rs1} + {immed}{wrap}')
+                used.update((rd, rs1))
+                written.add(rd)
+            elif op == 3:
+                target = (pc + immed) % self.MEM_SIZE
+                next_pc = f'{target} if r{rs1} == r{rs2} else {fall}'
+                used.update((rs1, rs2))
+            elif op == 4:
+                body.append(f'r{rd} = {pc + 1}')
+                used.add(rd)
+                written.add(rd)
+                next_pc = str((pc + immed) % self.MEM_SIZE)
+            elif op == 5:
+                body.append(f'r{rd} = mem[{immed} + r{rs1}]')
+                used.update((rd, rs1))
+                written.add(rd)
+            elif op == 6:
+                body.append(f'address = {immed} + r{rs2}')
+                body.append(f'mem[address] = r{rs1}')
+                used.update((rs1, rs2))
+                next_pc = str(fall)
+            elif op == 7:
+                next_pc = str(fall)
+
+            if next_pc is None and length == self.MAX_BLOCK_LENGTH:
+                next_pc = str(fall)
+            pc = fall
+
+        lines = ['def block(regs, mem, invalidate):']
+        lines += [f'    r{r} = regs[{r}]' for r in sorted(used)]
+        lines += [f'    {line}' for line in body]
+        lines.append(f'    next_pc = {next_pc}')
+        lines += [f'    regs[{r}] = r{r}' for r in sorted(written)]
+        if op == 6:
+            lines.append('    invalidate(address)')
+        lines.append('    return next_pc')
+        source = '\n'.join(lines) + '\n'
+
+        namespace = {}
+        exec(compile(source, f'<block {start}>', 'exec'), namespace)
+        block = TranslatedBlock(start, length, op, namespace['block'], source)
+
+        self.blocks[start] = block
+        for offset in range(length):
+            address = (start + offset) % self.MEM_SIZE
+            self.block_map.setdefault(address, set()).add(start)
+
+        return block
+
+    # Runs the basic block starting at pc, returns it so callers can read
+    # last_opcode (to detect rtrn) and length (instructions executed)
+    def exec_block(self) -> TranslatedBlock:
+        block = self.blocks.get(self.pc)
+        if block is None:
+            block = self.translate_block(self.pc)
+
+        self.pc = block.run(self.regs, self.mem, self.invalidate)
+        self.next_pc = self.pc + 1
+        return block
+
+    def load_image(self, image, start: int = 0) -> None:
+        # image is a bytes-like object of little-endian 32 bit words
+        words = array('I')
+        words.frombytes(image)
+        if sys.byteorder == 'big':
+            words.byteswap()
+        self.mem[start: start + len(words)] = words
+        self.mark_dirty(start, len(words))
+        self.flush_decoded()
+
+    def mark_dirty(self, start: int, length: int) -> None:
+        first = start >> self.PAGE_BITS
+        last = (start + length - 1) >> self.PAGE_BITS
+        self.dirty_pages.update(range(first, last + 1))
+
+    def load_image_file(self, path: str, start: int = 0) -> None:
+        # mmap lets large images be copied into memory without reading them into bytes first
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as image:
+                self.load_image(image, start)
+
+    # Copies the architectural state, restore() accepts the returned tuple
+    def snapshot(self) -> tuple:
+        return self.pc, self.next_pc, self.regs[:], self.mem[:]
+
+    def restore(self, snapshot: tuple) -> None:
+        self.pc, self.next_pc, regs, mem = snapshot
+        self.regs[:] = regs
+        self.mem[:] = mem
+        self.mark_dirty(0, len(self.mem))
+        self.flush_decoded()
+
     def exec(self, i: Instruction) -> None:
 
         # if-elif was used in favor of match-case for python3 version compatibility
@@ -73,7 +303,8 @@ class Cpu:
         else:
             self.noop()
 
-        self.pc = self.next_pc
+        # Branch offsets are 16 bits, so they wrap around the 64K word address space
+        self.pc = self.next_pc % self.MEM_SIZE
         self.next_pc = self.pc + 1
 
     def noop(self) -> None:
@@ -103,6 +334,7 @@ class Cpu:
     def sw(self, rs1, rs2, immed) -> None:
         eff_address = immed + self.regs[rs2]
         self.mem[eff_address] = self.regs[rs1]
+        self.invalidate(eff_address)
 
     # return function, named this way to avoid conflict with built-in return
     def rtrn(self) -> None:
@@ -110,6 +342,764 @@ class Cpu:
         pass
 
 
+class CompactCpu(Cpu):
+    # Cpu whose registers and memory are array('I') buffers (4 bytes per word)
+    # with 32 bit wraparound, cheap enough to create thousands per process
+    WORD_MASK = 0xFFFFFFFF
+
+    def __init__(self):
+        self.pc = int()
+        self.next_pc = int()
+        self.mem = array('I', [0]) * self.MEM_SIZE
+        self.regs = array('I', [0]) * self.NUM_REGISTERS
+        self.decoded = {}
+        self.blocks = {}
+        self.block_map = {}
+        self.dirty_pages = set()
+
+    def load_image(self, image, start: int = 0) -> None:
+        # Copies straight into the memory buffer without building an intermediate array
+        if sys.byteorder == 'big':
+            return super().load_image(image, start)
+
+        view = memoryview(self.mem).cast('B')
+        view[start * 4: start * 4 + len(image)] = image
+        self.mark_dirty(start, len(image) // 4)
+        self.flush_decoded()
+
+    def load_image_file(self, path: str, start: int = 0) -> None:
+        if sys.byteorder == 'big':
+            return super().load_image_file(path, start)
+
+        view = memoryview(self.mem).cast('B')
+        with open(path, 'rb') as file:
+            length = file.readinto(view[start * 4:])
+        self.mark_dirty(start, length // 4)
+        self.flush_decoded()
+
+    def add(self, rd, rs1, rs2) -> None:
+        alu_result = self.regs[rs1] + self.regs[rs2]
+        self.regs[rd] = alu_result & self.WORD_MASK
+
+    def addi(self, rd, rs1, immed) -> None:
+        alu_result = self.regs[rs1] + immed
+        self.regs[rd] = alu_result & self.WORD_MASK
+
+
+class Profiler:
+    # Opt-in instrumentation: attach() shadows exec/exec_decoded on one Cpu
+    # instance and detach() removes them again, so an unprofiled Cpu runs the
+    # plain class methods with no checks. Translated blocks are not instrumented.
+    OPCODE_NAMES = ('noop', 'add', 'addi', 'beq', 'jal', 'lw', 'sw', 'rtrn')
+
+    def __init__(self):
+        self.pc_counts = Counter()
+        self.opcode_counts = Counter()
+        self.branch_taken = Counter()
+        self.branch_not_taken = Counter()
+        self.mem_reads = Counter()
+        self.mem_writes = Counter()
+
+    def record(self, cpu: Cpu, opcode: int, mem_rs: int, immed: int, beq_rs2: int) -> None:
+        self.pc_counts[cpu.pc] += 1
+        self.opcode_counts[opcode] += 1
+        if opcode == 3:
+            if cpu.regs[mem_rs] == cpu.regs[beq_rs2]:
+                self.branch_taken[cpu.pc] += 1
+            else:
+                self.branch_not_taken[cpu.pc] += 1
+        elif opcode == 5:
+            self.mem_reads[immed + cpu.regs[mem_rs]] += 1
+        elif opcode == 6:
+            self.mem_writes[immed + cpu.regs[mem_rs]] += 1
+
+    def attach(self, cpu: Cpu) -> None:
+        cpu_exec = cpu.exec
+        cpu_exec_decoded = cpu.exec_decoded
+
+        def exec(i: Instruction) -> None:
+            # beq compares Rs1/Rs2, lw addresses through Rs1 and sw through Rs2
+            mem_rs = i.Rs2 if i.opcode == 6 else i.Rs1
+            self.record(cpu, i.opcode, mem_rs, i.immed, i.Rs2)
+            cpu_exec(i)
+
+        def exec_decoded(d: DecodedInstruction) -> None:
+            # beq args are (rs1, rs2, immed), lw (rd, rs1, immed), sw (rs1, rs2, immed)
+            if d.opcode == 3:
+                self.record(cpu, d.opcode, d.args[0], d.args[2], d.args[1])
+            elif d.opcode in (5, 6):
+                self.record(cpu, d.opcode, d.args[1], d.args[2], 0)
+            else:
+                self.record(cpu, d.opcode, 0, 0, 0)
+            cpu_exec_decoded(d)
+
+        cpu.exec = exec
+        cpu.exec_decoded = exec_decoded
+
+    def detach(self, cpu: Cpu) -> None:
+        del cpu.exec
+        del cpu.exec_decoded
+
+    def to_dict(self) -> dict:
+        return {
+            'pc_counts': dict(self.pc_counts),
+            'opcode_counts': {self.OPCODE_NAMES[op] if op < len(self.OPCODE_NAMES) else str(op): count
+                              for op, count in self.opcode_counts.items()},
+            'branches': {pc: {'taken': self.branch_taken[pc], 'not_taken': self.branch_not_taken[pc]}
+                         for pc in sorted(set(self.branch_taken) | set(self.branch_not_taken))},
+            'mem_reads': dict(self.mem_reads),
+            'mem_writes': dict(self.mem_writes),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    # Flat profile, hottest pc first
+    def to_text(self, cpu: Cpu = None) -> str:
+        total = sum(self.pc_counts.values()) or 1
+        lines = [f'{"pc":>6} {"count":>12} {"%":>7}  instruction']
+        for pc, count in self.pc_counts.most_common():
+            name = ''
+            if cpu is not None:
+                op = cpu.decode(cpu.mem[pc]).opcode
+                name = self.OPCODE_NAMES[op] if op < len(self.OPCODE_NAMES) else str(op)
+            branch = ''
+            if pc in self.branch_taken or pc in self.branch_not_taken:
+                branch = f' (taken {self.branch_taken[pc]}, not taken {self.branch_not_taken[pc]})'
+            lines.append(f'{pc:>6} {count:>12} {count / total * 100:>6.2f}%  {name}{branch}')
+        return '\n'.join(lines)
+
+
+# ================================================
+# Assembler
+#
+# One instruction per line, "#" or ";" starts a comment, "label:" may prefix a line.
+#   add rd, rs1, rs2        addi rd, rs1, immed       beq rs1, rs2, target
+#   jal rd, target          lw rd, immed(rs1)         sw rs1, immed(rs2)
+#   noop                    rtrn                      .word value
+# beq/jal targets are labels (assembled as pc-relative offsets) or raw offsets.
+# Other immediates are zero-extended, so they are numbers from 0 to 65535
+# (decimal or 0x hex) or label addresses.
+
+OPCODES = {name: op for op, name in enumerate(Profiler.OPCODE_NAMES)}
+OPERANDS = {
+    'noop': (),
+    'add': ('rd', 'rs1', 'rs2'),
+    'addi': ('rd', 'rs1', 'immed'),
+    'beq': ('rs1', 'rs2', 'target'),
+    'jal': ('rd', 'target'),
+    'lw': ('rd', 'rs1', 'immed'),
+    'sw': ('rs1', 'rs2', 'immed'),
+    'rtrn': (),
+}
+MEMORY_OPERAND = re.compile(r'^(.+)\((r\d+)\)$')
+
+
+def parse_register(token: str, line_num: int) -> int:
+    if token[:1] != 'r' or not token[1:].isdigit() or int(token[1:]) >= Cpu.NUM_REGISTERS:
+        raise ValueError(f'line {line_num}: bad register {token!r}')
+    return int(token[1:])
+
+
+def parse_value(token: str, labels: dict, line_num: int) -> int:
+    if token in labels:
+        return labels[token]
+    try:
+        return int(token, 0)
+    except ValueError:
+        raise ValueError(f'line {line_num}: bad immediate or unknown label {token!r}') from None
+
+
+def assemble(source: str, origin: int = 0) -> bytes:
+    # Returns a little-endian image of 32 bit words meant to be loaded at origin
+    MAX_16_BIT = 65_535
+
+    # First pass: strip comments, record label addresses
+    labels = {}
+    lines = []
+    for line_num, line in enumerate(source.splitlines(), 1):
+        line = re.split('[#;]', line, maxsplit=1)[0].strip()
+        while ':' in line:
+            label, line = line.split(':', 1)
+            label, line = label.strip(), line.strip()
+            if label in labels:
+                raise ValueError(f'line {line_num}: duplicate label {label!r}')
+            labels[label] = origin + len(lines)
+        if line:
+            lines.append((line_num, line))
+
+    # Second pass: encode
+    words = array('I')
+    for pc, (line_num, line) in enumerate(lines, origin):
+        mnemonic, rest = (line.split(None, 1) + [''])[:2]
+        mnemonic = mnemonic.lower()
+        tokens = [token.strip() for token in rest.split(',')] if rest.strip() else []
+
+        if mnemonic == '.word':
+            if len(tokens) != 1:
+                raise ValueError(f'line {line_num}: .word takes one value')
+            words.append(parse_value(tokens[0], labels, line_num) & 0xFFFFFFFF)
+            continue
+        if mnemonic not in OPCODES:
+            raise ValueError(f'line {line_num}: unknown instruction {mnemonic!r}')
+
+        # lw/sw also accept "immed(rs)" for their last two operands
+        if mnemonic in ('lw', 'sw') and len(tokens) == 2:
+            match = MEMORY_OPERAND.match(tokens[1])
+            if match:
+                tokens = [tokens[0], match.group(2), match.group(1).strip()]
+
+        names = OPERANDS[mnemonic]
+        if len(tokens) != len(names):
+            raise ValueError(f'line {line_num}: {mnemonic} takes {len(names)} operands')
+
+        fields = {'rd': 0, 'rs1': 0, 'rs2': 0, 'immed': 0}
+        for name, token in zip(names, tokens):
+            if name == 'target':
+                value = parse_value(token, labels, line_num)
+                fields['immed'] = (value - pc if token in labels else value) & MAX_16_BIT
+            elif name == 'immed':
+                value = parse_value(token, labels, line_num)
+                if not 0 <= value <= MAX_16_BIT:
+                    raise ValueError(f'line {line_num}: immediate {token!r} out of range 0-{MAX_16_BIT}')
+                fields['immed'] = value
+            else:
+                fields[name] = parse_register(token, line_num)
+
+        words.append((OPCODES[mnemonic] << 28) + (fields['rd'] << 24) + (fields['rs1'] << 20) +
+                     (fields['rs2'] << 16) + fields['immed'])
+
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words.tobytes()
+
+
+def assemble_cached(source: str, origin: int = 0, cache_dir: str = None) -> bytes:
+    # Images are stored as <sha256 of origin + source>.bin so unchanged sources skip assembly
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'cpu-images')
+    key = hashlib.sha256(f'{origin}\n{source}'.encode()).hexdigest()
+    path = os.path.join(cache_dir, f'{key}.bin')
+
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+
+    image = assemble(source, origin)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary name first so concurrent runs never read a partial image
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(image)
+    os.replace(tmp_path, path)
+    return image
+
+
+def load_assembly(cpu: Cpu, source: str, origin: int = 0, cache_dir: str = None) -> None:
+    cpu.load_image(assemble_cached(source, origin, cache_dir), origin)
+    cpu.pc = origin
+    cpu.next_pc = origin + 1
+
+
+class RunResult:
+    # status is 'halted' (reached rtrn), 'step_limit', 'timeout' or 'fault'
+    # (memory access past the last word, pc is the faulting instruction and
+    # steps the instructions completed before it)
+    __slots__ = ('status', 'steps', 'pc', 'regs', 'mem_diff')
+
+    def __init__(self, status: str, steps: int, pc: int, regs: list, mem_diff: dict):
+        self.status = status
+        self.steps = steps
+        self.pc = pc
+        self.regs = regs
+        self.mem_diff = mem_diff
+
+
+def mem_diff(before, after, page_size: int = 256) -> dict:
+    # Compares page by page so unchanged pages are skipped with one slice compare
+    diff = {}
+    for start in range(0, len(after), page_size):
+        end = start + page_size
+        if before[start: end] != after[start: end]:
+            for address in range(start, min(end, len(after))):
+                if before[address] != after[address]:
+                    diff[address] = after[address]
+    return diff
+
+
+def fast_forward(cpu: Cpu, max_steps: int, deadline: float = None,
+                 check_interval: int = 4096) -> tuple:
+    # Runs translated blocks for at most max_steps instructions (exactly, by
+    # single stepping near the limit). Returns (steps, status) with status
+    # 'halted', 'step_limit', 'timeout' (time.perf_counter() past deadline)
+    # or 'fault' (lw/sw past the end of memory, cpu.pc left at the access).
+    RETURN = 7
+
+    steps = 0
+    blocks = 0
+    while steps < max_steps:
+        if max_steps - steps < cpu.MAX_BLOCK_LENGTH:
+            try:
+                opcode = cpu.step()
+            except IndexError:
+                return steps, 'fault'
+            steps += 1
+            if opcode == RETURN:
+                return steps, 'halted'
+            continue
+
+        try:
+            block = cpu.exec_block()
+        except IndexError:
+            # Blocks write registers back at their end and store last, so a
+            # faulting block changed nothing: single step to the access
+            while True:
+                try:
+                    cpu.step()
+                except IndexError:
+                    return steps, 'fault'
+                steps += 1
+        steps += block.length
+        if block.last_opcode == RETURN:
+            return steps, 'halted'
+
+        blocks += 1
+        if deadline is not None and blocks % check_interval == 0 and time.perf_counter() > deadline:
+            return steps, 'timeout'
+
+    return steps, 'step_limit'
+
+
+def run(program, start_pc: int = 0, max_steps: int = 10_000_000, regs=None,
+        timeout: float = None, check_interval: int = 4096) -> RunResult:
+    # program is a list of instruction words or a little-endian image, loaded at
+    # start_pc. timeout (seconds) is checked every check_interval blocks.
+    cpu = CompactCpu()
+    if isinstance(program, (bytes, bytearray, memoryview)):
+        cpu.load_image(program, start_pc)
+    else:
+        cpu.mem[start_pc: start_pc + len(program)] = array('I', program)
+    if regs is not None:
+        cpu.regs[:] = array('I', regs)
+    cpu.pc = start_pc
+    cpu.next_pc = start_pc + 1
+
+    initial_mem = cpu.mem[:]
+    deadline = None if timeout is None else time.perf_counter() + timeout
+    steps, status = fast_forward(cpu, max_steps, deadline, check_interval)
+
+    return RunResult(status, steps, cpu.pc, list(cpu.regs), mem_diff(initial_mem, cpu.mem))
+
+
+def run_batch(jobs, max_workers: int = None, **defaults):
+    # jobs is an iterable of dicts of keyword arguments for run(), defaults are
+    # applied to every job. Yields (job index, RunResult) as each one finishes.
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run, **{**defaults, **job}): idx
+                   for idx, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# ================================================
+# Checkpoints
+#
+# A checkpoint file is a sequence of records, each one:
+#   header  '<4sQII'   magic, total steps, pc, next_pc
+#   regs    '<16I'
+#   count   '<I'       number of pages that follow
+#   pages   '<I' page index followed by the page's words (little-endian)
+# The first record holds every non-zero page and later ones only the pages
+# dirtied since the previous record, so restoring replays the records in
+# order onto a zeroed CompactCpu.
+
+CHECKPOINT_MAGIC = b'CKPT'
+CHECKPOINT_HEADER = struct.Struct('<4sQII')
+CHECKPOINT_REGS = struct.Struct(f'<{Cpu.NUM_REGISTERS}I')
+CHECKPOINT_PAGE = struct.Struct('<I')
+
+
+def write_checkpoint(cpu: CompactCpu, file, steps: int, full: bool = False) -> None:
+    # full writes every non-zero page, programs copied straight into cpu.mem
+    # are never marked dirty
+    page_size = 1 << cpu.PAGE_BITS
+    file.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, steps, cpu.pc, cpu.next_pc))
+    file.write(CHECKPOINT_REGS.pack(*cpu.regs))
+
+    if full:
+        pages = [page for page in range(len(cpu.mem) // page_size)
+                 if any(cpu.mem[page * page_size: (page + 1) * page_size])]
+    else:
+        pages = sorted(cpu.dirty_pages)
+    file.write(CHECKPOINT_PAGE.pack(len(pages)))
+    for page in pages:
+        words = cpu.mem[page * page_size: (page + 1) * page_size]
+        if sys.byteorder == 'big':
+            words.byteswap()
+        file.write(CHECKPOINT_PAGE.pack(page))
+        file.write(words.tobytes())
+    file.flush()
+
+    cpu.dirty_pages.clear()
+
+
+def read_checkpoint_records(file):
+    # Yields (steps, pc, next_pc, regs, pages, end offset) for each complete
+    # record, pages being the raw page entries. A torn final record, as left
+    # by a crash mid-write, ends the sequence.
+    page_entry = CHECKPOINT_PAGE.size + (4 << CompactCpu.PAGE_BITS)
+    record = 0
+    while True:
+        header = file.read(CHECKPOINT_HEADER.size)
+        if len(header) < CHECKPOINT_HEADER.size:
+            return
+        magic, steps, pc, next_pc = CHECKPOINT_HEADER.unpack(header)
+        if magic != CHECKPOINT_MAGIC:
+            raise ValueError(f'{file.name}: bad checkpoint record {record}')
+        regs = file.read(CHECKPOINT_REGS.size)
+        count = file.read(CHECKPOINT_PAGE.size)
+        if len(regs) < CHECKPOINT_REGS.size or len(count) < CHECKPOINT_PAGE.size:
+            return
+        count, = CHECKPOINT_PAGE.unpack(count)
+        pages = file.read(count * page_entry)
+        if len(pages) < count * page_entry:
+            return
+
+        yield steps, pc, next_pc, CHECKPOINT_REGS.unpack(regs), pages, file.tell()
+        record += 1
+
+
+def read_checkpoint(path: str, index: int = None) -> tuple:
+    # Returns (cpu, steps) as of record number index, or the last complete record
+    page_size = 1 << CompactCpu.PAGE_BITS
+    page_entry = CHECKPOINT_PAGE.size + page_size * 4
+    num_pages = CompactCpu.MEM_SIZE // page_size
+    cpu = CompactCpu()
+    steps = None
+
+    with open(path, 'rb') as file:
+        records = read_checkpoint_records(file)
+        for record, (record_steps, pc, next_pc, regs, pages, _) in enumerate(records):
+            for offset in range(0, len(pages), page_entry):
+                page, = CHECKPOINT_PAGE.unpack_from(pages, offset)
+                if page >= num_pages:
+                    raise ValueError(f'{path}: bad page {page} in checkpoint record {record}')
+                words = array('I')
+                words.frombytes(pages[offset + CHECKPOINT_PAGE.size: offset + page_entry])
+                if sys.byteorder == 'big':
+                    words.byteswap()
+                cpu.mem[page * page_size: (page + 1) * page_size] = words
+
+            cpu.pc, cpu.next_pc = pc, next_pc
+            cpu.regs[:] = array('I', regs)
+            steps = record_steps
+            if record == index:
+                break
+
+    if steps is None:
+        raise ValueError(f'{path}: no checkpoint record {index or 0}')
+    return cpu, steps
+
+
+def run_with_checkpoints(cpu: CompactCpu, path: str, interval: int,
+                         max_steps: int, steps: int = 0) -> tuple:
+    # Appends a checkpoint every interval steps, pass the steps returned by
+    # read_checkpoint() to resume. Resuming drops the records after the one
+    # resumed from, replaying them would mix the old run's pages into the
+    # new one. Returns (steps, status).
+    if steps and os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as file:
+            end = next((end for record_steps, *_, end in read_checkpoint_records(file)
+                        if record_steps == steps), None)
+        if end is None:
+            raise ValueError(f'{path}: no checkpoint record at step {steps}')
+        os.truncate(path, end)
+
+    status = 'step_limit'
+    with open(path, 'ab') as file:
+        if steps == 0 or file.tell() == 0:
+            write_checkpoint(cpu, file, steps, full=True)
+        while steps < max_steps:
+            ran, status = fast_forward(cpu, min(interval, max_steps - steps))
+            steps += ran
+            write_checkpoint(cpu, file, steps)
+            if status != 'step_limit':
+                break
+            status = 'step_limit'
+    return steps, status
+
+
+def sample(cpu: Cpu, profiler: Profiler, skip_steps: int, detail_steps: int,
+           max_steps: int) -> tuple:
+    # Alternates fast-forwarding skip_steps with translated blocks and running
+    # detail_steps with the profiler attached. Returns (steps, status).
+    RETURN = 7
+
+    steps = 0
+    while steps < max_steps:
+        ran, status = fast_forward(cpu, min(skip_steps, max_steps - steps))
+        steps += ran
+        if status != 'step_limit':
+            return steps, status
+
+        profiler.attach(cpu)
+        try:
+            for _ in range(min(detail_steps, max_steps - steps)):
+                steps += 1
+                if cpu.step() == RETURN:
+                    return steps, 'halted'
+        finally:
+            profiler.detach(cpu)
+
+    return steps, 'step_limit'
+
+
+# ================================================
+# Memory system
+#
+# MemoryObserver.attach() shadows exec/exec_decoded/lw/sw on one Cpu instance,
+# like Profiler, and reports every instruction fetch, load and store to
+# observe(kind, byte address, stored word), word address w being byte address
+# 4 * w. Translated blocks are not observed, so observed Cpus run with step().
+# Access kinds and the binary trace format are those of the cache simulator
+# in programming-assignment-2, whose Cache CacheCosim loads on first use.
+
+CACHE_SIMULATOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir, 'programming-assignment-2', 'main.py')
+CACHE_TRACE_MAGIC = b'CTRC'
+CACHE_TRACE_RECORD = struct.Struct('<BQI')
+
+_cache_simulator = None
+
+
+def load_cache_simulator():
+    global _cache_simulator
+    if _cache_simulator is None:
+        spec = importlib.util.spec_from_file_location('cachesim', CACHE_SIMULATOR_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _cache_simulator = module
+    return _cache_simulator
+
+
+def make_cache(**config):
+    # Silent cache simulator Cache covering the Cpu's byte addresses,
+    # config overrides the CacheConfig defaults
+    cachesim = load_cache_simulator()
+    config.setdefault('memory_size', Cpu.MEM_SIZE * 4)
+    return cachesim.Cache(cachesim.CacheConfig(**config), log=None)
+
+
+class MemoryObserver:
+    ACCESS_READ = 0
+    ACCESS_WRITE = 1
+    ACCESS_FETCH = 2
+
+    def observe(self, kind: int, address: int, word: int) -> None:
+        raise NotImplementedError
+
+    def attach(self, cpu: Cpu) -> None:
+        FETCH, READ, WRITE = self.ACCESS_FETCH, self.ACCESS_READ, self.ACCESS_WRITE
+        MAX_WORD = 0xFFFFFFFF
+        observe = self.observe
+        cpu_exec = cpu.exec
+        cpu_exec_decoded = cpu.exec_decoded
+        cpu_lw = cpu.lw
+        cpu_sw = cpu.sw
+
+        def exec(i: Instruction) -> None:
+            observe(FETCH, cpu.pc * 4, None)
+            cpu_exec(i)
+
+        def exec_decoded(d: DecodedInstruction) -> None:
+            observe(FETCH, cpu.pc * 4, None)
+            cpu_exec_decoded(d)
+
+        def lw(rd, rs1, immed) -> None:
+            observe(READ, (immed + cpu.regs[rs1]) * 4, None)
+            cpu_lw(rd, rs1, immed)
+
+        def sw(rs1, rs2, immed) -> None:
+            observe(WRITE, (immed + cpu.regs[rs2]) * 4, cpu.regs[rs1] & MAX_WORD)
+            cpu_sw(rs1, rs2, immed)
+
+        cpu.exec = exec
+        cpu.exec_decoded = exec_decoded
+        cpu.lw = lw
+        cpu.sw = sw
+        # Decoded instructions hold the lw/sw handlers bound when they were decoded
+        cpu.flush_decoded()
+
+    def detach(self, cpu: Cpu) -> None:
+        del cpu.exec
+        del cpu.exec_decoded
+        del cpu.lw
+        del cpu.sw
+        cpu.flush_decoded()
+
+    def run(self, cpu: Cpu, max_steps: int = 10_000_000) -> tuple:
+        # Runs cpu observed until rtrn or max_steps, returns (steps, status)
+        RETURN = 7
+
+        self.attach(cpu)
+        try:
+            for steps in range(1, max_steps + 1):
+                if cpu.step() == RETURN:
+                    return steps, 'halted'
+        finally:
+            self.detach(cpu)
+        return max_steps, 'step_limit'
+
+
+class CacheCosim(MemoryObserver):
+    # Timing model: the Cpu's memory stays authoritative and the caches see the
+    # address stream. Every instruction takes one cycle plus miss_penalty
+    # cycles per cache miss. dcache None makes icache a unified cache.
+    def __init__(self, icache=None, dcache=None, miss_penalty: int = 100):
+        self.icache = make_cache() if icache is None else icache
+        self.dcache = self.icache if dcache is None else dcache
+        self.miss_penalty = miss_penalty
+        self.instructions = 0
+        self.stall_cycles = 0
+
+    def observe(self, kind: int, address: int, word: int) -> None:
+        if kind == self.ACCESS_FETCH:
+            self.instructions += 1
+            cache = self.icache
+        else:
+            cache = self.dcache
+        stats = cache.stats
+        misses = stats.misses
+        cache.worker_algo(address, kind != self.ACCESS_WRITE, word)
+        if stats.misses != misses:
+            self.stall_cycles += self.miss_penalty
+
+    @property
+    def cycles(self) -> int:
+        return self.instructions + self.stall_cycles
+
+    def report(self) -> dict:
+        caches = {'unified': self.icache} if self.dcache is self.icache else \
+            {'icache': self.icache, 'dcache': self.dcache}
+        return {
+            'instructions': self.instructions,
+            'cycles': self.cycles,
+            'cpi': self.cycles / self.instructions if self.instructions else 0.0,
+            **{name: {**cache.stats.as_dict(), **cache.traffic.as_dict()} for name, cache in caches.items()},
+        }
+
+
+class AddressTracer(MemoryObserver):
+    # Low overhead alternative to CacheCosim: appends the address stream to a
+    # binary cache trace for offline replay (the cache simulator's replay_trace
+    # or sweep). Records are buffered and written buffer_records at a time.
+    def __init__(self, path: str, buffer_records: int = 65536):
+        self.file = open(path, 'wb')
+        self.file.write(CACHE_TRACE_MAGIC)
+        self.buffer = bytearray()
+        self.buffer_size = buffer_records * CACHE_TRACE_RECORD.size
+        self.records = 0
+
+    def observe(self, kind: int, address: int, word: int) -> None:
+        self.buffer += CACHE_TRACE_RECORD.pack(kind, address, word or 0)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        self.records += len(self.buffer) // CACHE_TRACE_RECORD.size
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+
+class LockstepCpu:
+    # Runs N CompactCpu-equivalent lanes at once: regs is (N, 16) and mem is
+    # (N, 65536) uint32, each lane has its own pc and stops at its own rtrn.
+    # Lanes always fall through to pc + 1 (a scalar Cpu starting with next_pc = pc + 1)
+    MEM_SIZE = Cpu.MEM_SIZE
+    NUM_REGISTERS = Cpu.NUM_REGISTERS
+
+    def __init__(self, lanes: int):
+        if np is None:
+            raise ImportError('LockstepCpu requires numpy')
+
+        self.lanes = lanes
+        self.pc = np.zeros(lanes, dtype=np.int64)
+        self.regs = np.zeros((lanes, self.NUM_REGISTERS), dtype=np.uint32)
+        self.mem = np.zeros((lanes, self.MEM_SIZE), dtype=np.uint32)
+        self.halted = np.zeros(lanes, dtype=bool)
+        self.steps = np.zeros(lanes, dtype=np.int64)
+
+    def load_program(self, program, start_pc: int = 0) -> None:
+        self.mem[:, start_pc: start_pc + len(program)] = np.asarray(program, dtype=np.uint32)
+        self.pc[:] = start_pc
+
+    def effective_address(self, lanes, rs, immed):
+        eff_address = immed.astype(np.int64) + self.regs[lanes, rs]
+        if len(eff_address) and eff_address.max() >= self.MEM_SIZE:
+            raise IndexError('memory address out of range')
+        return eff_address
+
+    # Executes one instruction in every lane that has not returned yet,
+    # returns False once all lanes have returned
+    def step(self) -> bool:
+        MAX_4_BIT = 15
+        MAX_16_BIT = 65_535
+
+        lanes = np.flatnonzero(~self.halted)
+        if not len(lanes):
+            return False
+
+        pc = self.pc[lanes]
+        instruction = self.mem[lanes, pc]
+        opcode = (instruction >> 28) & MAX_4_BIT
+        rd = (instruction >> 24) & MAX_4_BIT
+        rs1 = (instruction >> 20) & MAX_4_BIT
+        rs2 = (instruction >> 16) & MAX_4_BIT
+        immed = instruction & MAX_16_BIT
+        next_pc = pc + 1
+
+        # Each lane executes exactly one instruction, masks pick the lanes per opcode
+        for op in range(1, 8):
+            m = opcode == op
+            if not m.any():
+                continue
+            lane = lanes[m]
+
+            if op == 1:
+                self.regs[lane, rd[m]] = self.regs[lane, rs1[m]] + self.regs[lane, rs2[m]]
+            elif op == 2:
+                self.regs[lane, rd[m]] = self.regs[lane, rs1[m]] + immed[m]
+            elif op == 3:
+                taken = self.regs[lane, rs1[m]] == self.regs[lane, rs2[m]]
+                next_pc[m] = np.where(taken, pc[m] + immed[m], next_pc[m])
+            elif op == 4:
+                self.regs[lane, rd[m]] = pc[m] + 1
+                next_pc[m] = pc[m] + immed[m]
+            elif op == 5:
+                eff_address = self.effective_address(lane, rs1[m], immed[m])
+                self.regs[lane, rd[m]] = self.mem[lane, eff_address]
+            elif op == 6:
+                eff_address = self.effective_address(lane, rs2[m], immed[m])
+                self.mem[lane, eff_address] = self.regs[lane, rs1[m]]
+            elif op == 7:
+                self.halted[lane] = True
+
+        self.pc[lanes] = next_pc % self.MEM_SIZE
+        self.steps[lanes] += 1
+        return True
+
+    def run(self, max_steps: int = 10_000_000) -> None:
+        for _ in range(max_steps):
+            if not self.step():
+                break
+
+
 class TestCpuProgram(unittest.TestCase):
     MAX_16_BIT = 65536
 
@@ -227,6 +1217,585 @@ class TestCpuProgram(unittest.TestCase):
         self.assertEqual(cpu.regs, VALID_REGS)
         self.assertEqual(cpu.mem, VALID_MEMORY)
 
+    def load_program(self, cpu, instructions, memory_start=100):
+        for idx, elm in enumerate(range(memory_start, memory_start + len(instructions))):
+            cpu.mem[elm] = instructions[idx]
+        cpu.pc = memory_start
+
+    def run_exec_loop(self, cpu):
+        while True:
+            instruction = cpu.fetch()
+            instruction = cpu.decode(instruction)
+            cpu.exec(instruction)
+            if instruction.opcode == self.RETURN:
+                break
+
+    def run_cached_loop(self, cpu):
+        while cpu.step() != self.RETURN:
+            pass
+
+    def run_translated_loop(self, cpu):
+        while cpu.exec_block().last_opcode != self.RETURN:
+            pass
+
+    def test_cached_one(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_one()
+
+        cpu = Cpu()
+        self.load_program(cpu, self.get_instructions_one())
+        self.run_cached_loop(cpu)
+
+        self.assertEqual(cpu.regs, VALID_REGS)
+        self.assertEqual(cpu.mem, VALID_MEMORY)
+
+    def test_cached_two(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_two()
+
+        cpu = Cpu()
+        self.load_program(cpu, self.get_instructions_two())
+        self.run_cached_loop(cpu)
+
+        self.assertEqual(cpu.regs, VALID_REGS)
+        self.assertEqual(cpu.mem, VALID_MEMORY)
+
+    def get_instructions_self_modifying(self):
+        # Loops twice over pc 102, and overwrites it with "addi r3, r3, 100" on the first pass
+        instructions = []
+        instructions.append((self.ADDI << 28) + (7 << 24) + (0 << 20) + 2)
+        instructions.append((self.LW << 28) + (6 << 24) + (0 << 20) + 200)
+        instructions.append((self.ADDI << 28) + (3 << 24) + (3 << 20) + 1)
+        instructions.append((self.ADDI << 28) + (4 << 24) + (4 << 20) + 1)
+        instructions.append((self.SW << 28) + (6 << 20) + (0 << 16) + 102)
+        instructions.append((self.BEQ << 28) + (4 << 20) + (7 << 16) + 2)
+        instructions.append((self.JAL << 28) + (15 << 24) + (self.MAX_16_BIT - 4))
+        instructions.append((self.RETURN << 28))
+
+        patch = (self.ADDI << 28) + (3 << 24) + (3 << 20) + 100
+
+        return instructions, patch
+
+    def test_cached_self_modifying(self):
+        instructions, patch = self.get_instructions_self_modifying()
+
+        expected = Cpu()
+        self.load_program(expected, instructions)
+        expected.mem[200] = patch
+        self.run_exec_loop(expected)
+
+        cpu = Cpu()
+        self.load_program(cpu, instructions)
+        cpu.mem[200] = patch
+        self.run_cached_loop(cpu)
+
+        self.assertEqual(expected.regs[3], 101)
+        self.assertEqual(cpu.regs, expected.regs)
+        self.assertEqual(cpu.mem, expected.mem)
+
+    def test_translated_one(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_one()
+
+        cpu = Cpu()
+        self.load_program(cpu, self.get_instructions_one())
+        self.run_translated_loop(cpu)
+
+        self.assertEqual(cpu.regs, VALID_REGS)
+        self.assertEqual(cpu.mem, VALID_MEMORY)
+
+    def test_translated_two(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_two()
+
+        cpu = Cpu()
+        self.load_program(cpu, self.get_instructions_two())
+        self.run_translated_loop(cpu)
+
+        self.assertEqual(cpu.regs, VALID_REGS)
+        self.assertEqual(cpu.mem, VALID_MEMORY)
+
+    def test_translated_self_modifying(self):
+        instructions, patch = self.get_instructions_self_modifying()
+
+        expected = Cpu()
+        self.load_program(expected, instructions)
+        expected.mem[200] = patch
+        self.run_exec_loop(expected)
+
+        cpu = Cpu()
+        self.load_program(cpu, instructions)
+        cpu.mem[200] = patch
+        self.run_translated_loop(cpu)
+
+        self.assertEqual(cpu.regs, expected.regs)
+        self.assertEqual(cpu.mem, expected.mem)
+        self.assertEqual((cpu.pc, cpu.next_pc), (expected.pc, expected.next_pc))
+
+    def test_compact_one(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_one()
+
+        cpu = CompactCpu()
+        self.load_program(cpu, self.get_instructions_one())
+        self.run_translated_loop(cpu)
+
+        self.assertEqual(list(cpu.regs), VALID_REGS)
+        self.assertEqual(list(cpu.mem), VALID_MEMORY)
+
+    def test_compact_two(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_two()
+
+        cpu = CompactCpu()
+        self.load_program(cpu, self.get_instructions_two())
+        self.run_exec_loop(cpu)
+
+        self.assertEqual(list(cpu.regs), VALID_REGS)
+        self.assertEqual(list(cpu.mem), VALID_MEMORY)
+
+    def test_compact_wraparound(self):
+        instructions = []
+        instructions.append((self.ADD << 28) + (2 << 24) + (1 << 20) + (1 << 16))
+        instructions.append((self.ADDI << 28) + (3 << 24) + (1 << 20) + 1)
+        instructions.append((self.RETURN << 28))
+
+        for run_loop in (self.run_exec_loop, self.run_translated_loop):
+            cpu = CompactCpu()
+            self.load_program(cpu, instructions)
+            cpu.regs[1] = 0xFFFFFFFF
+            run_loop(cpu)
+
+            self.assertEqual(cpu.regs[2], 0xFFFFFFFE)
+            self.assertEqual(cpu.regs[3], 0)
+
+    def test_load_image_and_snapshot(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_one()
+        image = array('I', self.get_instructions_one())
+        if sys.byteorder == 'big':
+            image.byteswap()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'one.bin')
+            with open(path, 'wb') as file:
+                file.write(image.tobytes())
+
+            for cpu in (Cpu(), CompactCpu()):
+                cpu.load_image(image.tobytes(), 100)
+                cpu.pc = 100
+                snapshot = cpu.snapshot()
+
+                self.run_cached_loop(cpu)
+                self.assertEqual(list(cpu.regs), VALID_REGS)
+                self.assertEqual(list(cpu.mem), VALID_MEMORY)
+
+                cpu.restore(snapshot)
+                self.assertEqual(cpu.pc, 100)
+                self.assertEqual(list(cpu.regs), [0] * Cpu.NUM_REGISTERS)
+                self.assertEqual(cpu.mem[20], 0)
+
+                cpu.load_image_file(path, 100)
+                self.run_translated_loop(cpu)
+                self.assertEqual(list(cpu.regs), VALID_REGS)
+                self.assertEqual(list(cpu.mem), VALID_MEMORY)
+
+    def test_run(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_one()
+
+        result = run(self.get_instructions_one(), 100)
+
+        self.assertEqual(result.status, 'halted')
+        self.assertEqual(result.steps, 11)
+        self.assertEqual(result.regs, VALID_REGS)
+        self.assertEqual(result.mem_diff, {20: 2})
+
+    def test_run_step_limit(self):
+        # beq r0, r0, 0 branches to itself forever
+        result = run([(self.BEQ << 28)], 100, max_steps=1000)
+
+        self.assertEqual(result.status, 'step_limit')
+        self.assertEqual(result.steps, 1000)
+        self.assertEqual(result.pc, 100)
+
+    def test_run_batch(self):
+        jobs = [
+            {'program': self.get_instructions_one(), 'start_pc': 100},
+            {'program': self.get_instructions_two(), 'start_pc': 100},
+            {'program': [(self.BEQ << 28)], 'max_steps': 10 ** 12, 'timeout': 0.1},
+            {'program': assemble(self.SOURCE_FAULT, 100), 'start_pc': 100,
+             'regs': [0, 0, 5] + [0] * 13},
+        ]
+
+        results = dict(run_batch(jobs, max_workers=2))
+
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+        self.assertEqual(results[0].regs, self.load_validation_data_one()[0])
+        self.assertEqual(results[1].regs, self.load_validation_data_two()[0])
+        self.assertEqual(results[1].mem_diff, {1010: 2})
+        self.assertEqual(results[2].status, 'timeout')
+        self.assertEqual((results[3].status, results[3].pc, results[3].steps), ('fault', 101, 1))
+        self.assertEqual(results[3].regs[3], 7)
+
+    # lw reads word 5 + 0xffff, past the end of memory
+    SOURCE_FAULT = """
+            addi r3, r0, 7
+            lw r1, 0xffff(r2)
+            rtrn
+    """
+
+    def test_run_fault(self):
+        # Faults inside a translated block and while single stepping near max_steps
+        for max_steps in (10 ** 6, 10):
+            result = run(assemble(self.SOURCE_FAULT, 100), 100, max_steps,
+                         regs=[0, 0, 5] + [0] * 13)
+            self.assertEqual((result.status, result.pc, result.steps), ('fault', 101, 1))
+            self.assertEqual(result.regs[3], 7)
+            self.assertEqual(result.mem_diff, {})
+
+    SOURCE_ONE = """
+            noop
+            addi r1, r0, 1
+            addi r2, r0, 2
+            add r3, r1, r1
+            add r4, r2, r2
+            beq r3, r4, skip        # not taken, r3 = 2 and r4 = 4
+            addi r8, r0, 10
+            jal r0, store
+    skip:   addi r8, r0, 1000
+    store:  sw r2, 10(r8)
+            lw r5, 10(r8)           ; reads back the stored word
+            rtrn
+    """
+
+    def test_assemble(self):
+        image = array('I')
+        image.frombytes(assemble(self.SOURCE_ONE, 100))
+        if sys.byteorder == 'big':
+            image.byteswap()
+
+        self.assertEqual(list(image), self.get_instructions_one())
+
+    def test_assemble_loop(self):
+        source = """
+            addi\tr2, r0, 5
+    loop:   addi r1, r1, 1
+            beq r1, r2, done
+            jal r15, loop
+    done:   rtrn
+            .word -1
+        """
+        image = array('I')
+        image.frombytes(assemble(source, 100))
+
+        self.assertEqual(list(image[:5]), self.get_instructions_loop(5))
+        self.assertEqual(image[5], 0xFFFFFFFF)
+
+    def test_assemble_errors(self):
+        for source in ('bogus r1', 'add r1, r2', 'addi r16, r0, 1', 'beq r1, r2, nowhere',
+                       'a: noop\na: noop', 'addi r1, r0, -1', 'lw r1, 0x10000(r0)'):
+            with self.assertRaises(ValueError):
+                assemble(source)
+
+    def test_load_assembly_cached(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_one()
+
+        with tempfile.TemporaryDirectory() as directory:
+            for _ in range(2):
+                cpu = Cpu()
+                load_assembly(cpu, self.SOURCE_ONE, 100, directory)
+                self.run_cached_loop(cpu)
+
+                self.assertEqual(cpu.regs[1:], VALID_REGS[1:])
+                self.assertEqual(cpu.mem, VALID_MEMORY)
+                self.assertEqual(len(os.listdir(directory)), 1)
+
+            path = os.path.join(directory, os.listdir(directory)[0])
+            cpu = Cpu()
+            cpu.load_image_file(path, 100)
+            self.assertEqual(cpu.mem[100:112], self.get_instructions_one())
+
+    def test_profiler(self):
+        VALID_REGS, VALID_MEMORY = self.load_validation_data_two()
+
+        for run_loop in (self.run_exec_loop, self.run_cached_loop):
+            cpu = Cpu()
+            self.load_program(cpu, self.get_instructions_two())
+            cpu.next_pc = cpu.pc + 1
+            profiler = Profiler()
+            profiler.attach(cpu)
+            run_loop(cpu)
+            profiler.detach(cpu)
+
+            self.assertEqual(cpu.regs, VALID_REGS)
+            self.assertNotIn('exec', vars(cpu))
+            self.assertEqual(sum(profiler.pc_counts.values()), 9)
+            self.assertEqual(profiler.opcode_counts[self.ADDI], 3)
+            self.assertEqual(profiler.branch_taken[104], 1)
+            self.assertEqual(profiler.mem_writes, {1010: 1})
+            self.assertEqual(profiler.mem_reads, {1010: 1})
+
+            data = json.loads(profiler.to_json())
+            self.assertEqual(data['opcode_counts']['rtrn'], 1)
+            self.assertEqual(data['branches']['104'], {'taken': 1, 'not_taken': 0})
+            self.assertIn('beq (taken 1, not taken 0)', profiler.to_text(cpu))
+
+    def test_checkpoints(self):
+        iterations = 1000
+        instructions = self.get_instructions_loop(iterations)
+        # The loop body stores r1 to 3000 + r1, dirtying a page every 256 iterations
+        instructions.insert(2, (self.SW << 28) + (1 << 20) + (1 << 16) + 3000)
+        instructions[4] -= 1
+
+        expected = CompactCpu()
+        self.load_program(expected, instructions)
+        expected.next_pc = expected.pc + 1
+        expected_steps, _ = fast_forward(expected, 10 ** 6)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run.ckpt')
+
+            cpu = CompactCpu()
+            self.load_program(cpu, instructions)
+            cpu.next_pc = cpu.pc + 1
+            steps, status = run_with_checkpoints(cpu, path, 500, 2000)
+            self.assertEqual((steps, status), (2000, 'step_limit'))
+
+            # Resume from the 3rd record (1000 steps) and run to completion
+            resumed, steps = read_checkpoint(path, 2)
+            self.assertEqual(steps, 1000)
+            steps, status = run_with_checkpoints(resumed, path, 500, 10 ** 6, steps)
+
+            self.assertEqual((steps, status), (expected_steps, 'halted'))
+            self.assertEqual(list(resumed.regs), list(expected.regs))
+            self.assertEqual(resumed.mem, expected.mem)
+
+            last, steps = read_checkpoint(path)
+            self.assertEqual(steps, expected_steps)
+            self.assertEqual(last.mem, expected.mem)
+
+    SOURCE_PAGES = """
+            addi r2, r0, 150
+    loop:   addi r1, r1, 1
+            addi r3, r3, 256
+            sw r1, 0(r3)            # a new page every iteration
+            beq r1, r2, done
+            jal r0, loop
+    done:   rtrn
+    """
+
+    def test_checkpoint_resume_and_torn_records(self):
+        with tempfile.TemporaryDirectory() as directory:
+            def reference(steps):
+                cpu = CompactCpu()
+                load_assembly(cpu, self.SOURCE_PAGES, 100, directory)
+                fast_forward(cpu, steps)
+                return cpu
+
+            path = os.path.join(directory, 'run.ckpt')
+            cpu = reference(0)
+            self.assertEqual(run_with_checkpoints(cpu, path, 100, 500), (500, 'step_limit'))
+
+            # Resuming from 200 steps drops the records for 300-500 steps
+            resumed, steps = read_checkpoint(path, 2)
+            self.assertEqual(steps, 200)
+            steps, status = run_with_checkpoints(resumed, path, 100, 10 ** 6, steps)
+            self.assertEqual(status, 'halted')
+
+            with open(path, 'rb') as file:
+                record_steps = [record[0] for record in read_checkpoint_records(file)]
+            self.assertEqual(record_steps, list(range(0, steps, 100)) + [steps])
+            for index, expected_steps in enumerate(record_steps):
+                restored, restored_steps = read_checkpoint(path, index)
+                expected = reference(expected_steps)
+                self.assertEqual(restored_steps, expected_steps)
+                self.assertEqual(list(restored.regs), list(expected.regs))
+                self.assertEqual(restored.mem, expected.mem)
+
+            # A torn last record is skipped, restoring the one before it
+            with open(path, 'rb') as file:
+                data = file.read()
+            before_last, before_last_steps = read_checkpoint(path, len(record_steps) - 2)
+            torn_path = os.path.join(directory, 'torn.ckpt')
+            for cut in (8, 10, 100, 600):
+                with open(torn_path, 'wb') as file:
+                    file.write(data[:-cut])
+                torn, torn_steps = read_checkpoint(torn_path)
+                self.assertEqual(torn_steps, before_last_steps)
+                self.assertEqual(len(torn.mem), CompactCpu.MEM_SIZE)
+                self.assertEqual(torn.mem, before_last.mem)
+
+    def test_sample(self):
+        cpu = CompactCpu()
+        self.load_program(cpu, self.get_instructions_loop(1000))
+        cpu.next_pc = cpu.pc + 1
+        profiler = Profiler()
+
+        steps, status = sample(cpu, profiler, 100, 10, 10 ** 6)
+
+        self.assertEqual((steps, status), (3001, 'halted'))
+        self.assertEqual(cpu.regs[1], 1000)
+        self.assertNotIn('exec', vars(cpu))
+        self.assertEqual(sum(profiler.pc_counts.values()), 270)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_lockstep_matches_scalar(self):
+        # Every lane loops a different number of times, so the pcs diverge
+        lanes = 16
+        programs = (self.get_instructions_two(), self.get_instructions_loop(lanes))
+        for instructions in programs:
+            lockstep = LockstepCpu(lanes)
+            lockstep.load_program(instructions, 100)
+            lockstep.regs[:, 1] = np.arange(lanes) % 3
+            lockstep.regs[:, 2] = np.arange(1, lanes + 1)
+            lockstep.run()
+
+            for lane in range(lanes):
+                cpu = CompactCpu()
+                self.load_program(cpu, instructions)
+                cpu.next_pc = cpu.pc + 1
+                cpu.regs[1] = lane % 3
+                cpu.regs[2] = lane + 1
+                steps = 0
+                while True:
+                    steps += 1
+                    if cpu.step() == self.RETURN:
+                        break
+
+                self.assertEqual(lockstep.steps[lane], steps)
+                self.assertEqual(lockstep.pc[lane], cpu.pc)
+                self.assertEqual(lockstep.regs[lane].tolist(), list(cpu.regs))
+                self.assertEqual(lockstep.mem[lane].tolist(), list(cpu.mem))
+
+    def get_instructions_loop(self, iterations):
+        # r1 counts up to r2, jal jumps back 2 words by wrapping around memory
+        instructions = []
+        instructions.append((self.ADDI << 28) + (2 << 24) + (0 << 20) + iterations)
+        instructions.append((self.ADDI << 28) + (1 << 24) + (1 << 20) + 1)
+        instructions.append((self.BEQ << 28) + (1 << 20) + (2 << 16) + 2)
+        instructions.append((self.JAL << 28) + (15 << 24) + (self.MAX_16_BIT - 2))
+        instructions.append((self.RETURN << 28))
+
+        return instructions
+
+    SOURCE_SUM = """
+            addi r2, r0, 64
+    loop:   lw r3, 1024(r1)         # running sum of mem[1024:1088] into mem[2048:2112]
+            add r4, r4, r3
+            sw r4, 2048(r1)
+            addi r1, r1, 1
+            beq r1, r2, done
+            jal r15, loop
+    done:   rtrn
+    """
+
+    def load_sum(self, directory):
+        cpu = Cpu()
+        load_assembly(cpu, self.SOURCE_SUM, 100, directory)
+        cpu.mem[1024:1088] = list(range(64))
+        return cpu
+
+    def test_cache_cosim(self):
+        with tempfile.TemporaryDirectory() as directory:
+            expected = self.load_sum(directory)
+            self.run_cached_loop(expected)
+
+            split = CacheCosim(make_cache(cache_size=256), make_cache(cache_size=1024))
+            unified = CacheCosim(miss_penalty=10)
+            for cosim in (split, unified):
+                cpu = self.load_sum(directory)
+                steps, status = cosim.run(cpu)
+
+                self.assertEqual(status, 'halted')
+                self.assertEqual(cpu.regs, expected.regs)
+                self.assertEqual(cpu.mem, expected.mem)
+                self.assertFalse({'exec', 'exec_decoded', 'lw', 'sw'} & set(vars(cpu)))
+                self.assertEqual(cosim.instructions, steps)
+                misses = cosim.icache.stats.misses + (0 if cosim.dcache is cosim.icache else cosim.dcache.stats.misses)
+                self.assertEqual(cosim.cycles, steps + misses * cosim.miss_penalty)
+
+            # Code fits one block, 64 loaded and 64 stored words span 4 blocks each
+            report = split.report()
+            self.assertEqual(report['icache']['misses'], 1)
+            self.assertEqual(report['dcache']['reads'], 64)
+            self.assertEqual(report['dcache']['writes'], 64)
+            self.assertEqual(report['dcache']['misses'], 8)
+            self.assertEqual(unified.report()['unified']['misses'], 9)
+
+    def test_address_tracer(self):
+        cachesim = load_cache_simulator()
+        with tempfile.TemporaryDirectory() as directory:
+            cosim = CacheCosim()
+            steps, status = cosim.run(self.load_sum(directory))
+
+            path = os.path.join(directory, 'trace.bin')
+            tracer = AddressTracer(path, buffer_records=100)
+            tracer.run(self.load_sum(directory))
+            tracer.close()
+
+            self.assertEqual(tracer.records, steps + 128)
+            stats = cachesim.replay_trace(path, cachesim.CacheConfig(memory_size=Cpu.MEM_SIZE * 4))
+            self.assertEqual(stats, cosim.icache.stats)
+
+
+class TestCpuBenchmark(unittest.TestCase):
+    ITERATIONS = 20_000
+
+    def time_loop(self, run_loop):
+        cpu = Cpu()
+        program = TestCpuProgram()
+        program.load_program(cpu, program.get_instructions_loop(self.ITERATIONS))
+        cpu.next_pc = cpu.pc + 1
+
+        start = time.perf_counter()
+        run_loop(cpu)
+        elapsed = time.perf_counter() - start
+
+        return cpu, elapsed
+
+    def test_decoded_cache(self):
+        program = TestCpuProgram()
+        exec_cpu, exec_time = self.time_loop(program.run_exec_loop)
+        cached_cpu, cached_time = self.time_loop(program.run_cached_loop)
+
+        print(f'\nfetch/decode/exec: {exec_time:.4f}s, decoded cache: {cached_time:.4f}s '
+              f'({exec_time / cached_time:.2f}x)')
+
+        self.assertEqual(cached_cpu.regs[1], self.ITERATIONS)
+        self.assertEqual(cached_cpu.regs, exec_cpu.regs)
+        self.assertEqual(cached_cpu.mem, exec_cpu.mem)
+
+    def test_translated_blocks(self):
+        program = TestCpuProgram()
+        exec_cpu, exec_time = self.time_loop(program.run_exec_loop)
+        translated_cpu, translated_time = self.time_loop(program.run_translated_loop)
+
+        print(f'\nfetch/decode/exec: {exec_time:.4f}s, translated blocks: {translated_time:.4f}s '
+              f'({exec_time / translated_time:.2f}x)')
+
+        self.assertEqual(translated_cpu.regs, exec_cpu.regs)
+        self.assertEqual(translated_cpu.mem, exec_cpu.mem)
+
+    def test_profiler_detached(self):
+        # A Cpu that was profiled and then detached runs the same code as one never profiled
+        program = TestCpuProgram()
+        plain_cpu, plain_time = self.time_loop(program.run_cached_loop)
+
+        profiler = Profiler()
+
+        def run_profiled(cpu):
+            profiler.attach(cpu)
+            program.run_cached_loop(cpu)
+
+        def run_detached(cpu):
+            profiler.attach(cpu)
+            profiler.detach(cpu)
+            program.run_cached_loop(cpu)
+
+        profiled_cpu, profiled_time = self.time_loop(run_profiled)
+        detached_cpu, detached_time = self.time_loop(run_detached)
+
+        print(f'\nunprofiled: {plain_time:.4f}s, detached: {detached_time:.4f}s, '
+              f'profiled: {profiled_time:.4f}s')
+
+        self.assertEqual(vars(detached_cpu).keys(), vars(plain_cpu).keys())
+        self.assertEqual(detached_cpu.regs, plain_cpu.regs)
+        self.assertEqual(profiled_cpu.regs, plain_cpu.regs)
+        self.assertEqual(sum(profiler.pc_counts.values()), 3 * self.ITERATIONS + 1)
+
 
 if __name__ == '__main__':
     unittest.main()
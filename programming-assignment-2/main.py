@@ -3,16 +3,82 @@
 #
 # Example data structures
 # for a direct-mapped cache
+import argparse
+import csv
+import hashlib
+import json
+import mmap
+import os
+import sys
+import tracemalloc
+import random
+import struct
+import tempfile
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Defaults for CacheConfig
 MEMORY_SIZE = 65536  # 2^16
 CACHE_SIZE = 1024  # 2^10
 CACHE_BLOCK_SIZE = 64    # 2^6
 ASSOCIATIVITY = 4
-memory = bytearray(MEMORY_SIZE)
 
 WRITE_BACK = True
+WRITE_ALLOCATE = True
+WRITE_BUFFER_DEPTH = 0  # pending block writes, 0 writes straight to memory
 # ================================================
 
 
+class CacheConfig:
+    # Geometry of one Cache, with the address split precomputed
+    def __init__(self, cache_size=CACHE_SIZE, cache_block_size=CACHE_BLOCK_SIZE,
+                 associativity=ASSOCIATIVITY, memory_size=MEMORY_SIZE, write_back=WRITE_BACK,
+                 write_allocate=WRITE_ALLOCATE, write_buffer_depth=WRITE_BUFFER_DEPTH):
+        for name, value in (('cache_size', cache_size), ('cache_block_size', cache_block_size),
+                            ('associativity', associativity), ('memory_size', memory_size)):
+            assert value > 0 and value & (value - 1) == 0, f'{name} must be a power of 2'
+        assert cache_size >= cache_block_size * associativity, 'cache too small for one set'
+        assert write_buffer_depth >= 0, 'write_buffer_depth must not be negative'
+
+        self.cache_size = cache_size
+        self.cache_block_size = cache_block_size
+        self.associativity = associativity
+        self.memory_size = memory_size
+        self.write_back = write_back
+        self.write_allocate = write_allocate
+        self.write_buffer_depth = write_buffer_depth
+
+        self.num_blocks = cache_size // cache_block_size
+        self.num_sets = self.num_blocks // associativity
+        self.memory_size_bits = logb2(memory_size)
+        self.block_offset_length = logb2(cache_block_size)
+        self.index_length = logb2(self.num_sets)
+        self.tag_length = self.memory_size_bits - self.index_length - self.block_offset_length
+
+        self.offset_mask = cache_block_size - 1
+        self.index_shift = self.block_offset_length
+        self.index_mask = self.num_sets - 1
+        self.tag_shift = self.index_shift + self.index_length
+
+    @classmethod
+    def from_sets(cls, num_sets, associativity, cache_block_size=CACHE_BLOCK_SIZE, **kwargs):
+        return cls(num_sets * associativity * cache_block_size, cache_block_size, associativity, **kwargs)
+
+    def __repr__(self):
+        return (f'CacheConfig(cache_size={self.cache_size}, cache_block_size={self.cache_block_size}, '
+                f'associativity={self.associativity}, memory_size={self.memory_size}, '
+                f'write_back={self.write_back}, write_allocate={self.write_allocate}, '
+                f'write_buffer_depth={self.write_buffer_depth})')
+# ================================================
+
+
+# Little-endian 32 bit word
+WORD = struct.Struct('<I')
+MAX_WORD = 0xFFFFFFFF  # 2^32 - 1
+
+
 class CacheBlock:
     def __init__(self, cache_block_size):
         self.tag = -1
@@ -21,260 +87,661 @@ class CacheBlock:
         self.data = bytearray(cache_block_size)
 
     def read_from_offset(self, offset):
+        if offset % 4 == 0:
+            return WORD.unpack_from(self.data, offset)[0]
+
+    def write_from_offset(self, word, offset):
+        if offset % 4 == 0:
+            WORD.pack_into(self.data, offset, word & MAX_WORD)
+
+    def read_from_memory(self, memory, start_addr, end_addr):
+        self.data = bytearray(memory[start_addr: end_addr + 1])
 
+
+class BufferCacheBlock:
+    # CacheBlock whose data lives at storage[base: base + size] of one buffer
+    # shared by the whole Cache, so fills copy in place instead of allocating
+    __slots__ = ('tag', 'dirty', 'valid', 'storage', 'base', 'size')
+
+    def __init__(self, storage, base, cache_block_size):
+        self.tag = -1
+        self.dirty = False
+        self.valid = False
+        self.storage = storage
+        self.base = base
+        self.size = cache_block_size
+
+    @property
+    def data(self):
+        return self.storage[self.base: self.base + self.size]
+
+    def read_from_offset(self, offset):
         if offset % 4 == 0:
-            value = self.data[offset] + (self.data[offset + 1] << 8) + \
-                (self.data[offset + 2] << 16) + (self.data[offset + 3] << 24)
-            return value
+            return WORD.unpack_from(self.storage, self.base + offset)[0]
 
     def write_from_offset(self, word, offset):
         if offset % 4 == 0:
-            MAX_BYTE_NUM = 255  # 2^8 - 1
-            self.data[offset + 3] = (word >> 24) & MAX_BYTE_NUM
-            self.data[offset + 2] = (word >> 16) & MAX_BYTE_NUM
-            self.data[offset + 1] = (word >> 8) & MAX_BYTE_NUM
-            self.data[offset] = (word) & MAX_BYTE_NUM
+            WORD.pack_into(self.storage, self.base + offset, word & MAX_WORD)
 
-    def read_from_memory(self, start_addr, end_addr):
-        self.data = memory[start_addr: end_addr + 1]
+    def read_from_memory(self, memory, start_addr, end_addr):
+        self.storage[self.base: self.base + self.size] = memory[start_addr: end_addr + 1]
 
 
 # ================================================
 
 
 class CacheSet:
+    # lookup() and allocate() are the interface Cache uses, both keep the LRU
+    # tag_queue up to date and mru holds the most recently used tag
     def __init__(self, cache_block_size, associativity):
         self.blocks = [CacheBlock(cache_block_size)
                        for i in range(associativity)]
         self.tag_queue = [-1 for i in range(associativity)]
+        self.mru = -1
+
+    def lookup(self, tag):
+        # Returns the block index holding tag, or None on a miss
+        for block_idx, block in enumerate(self.blocks):
+            if (block.tag == tag) and (block.valid):
+                self.move_to_end_of_tag_queue(tag)
+                return block_idx
+        return None
+
+    def allocate(self, tag):
+        # Returns (block index to fill, evicted tag or None)
+        for block_idx, block in enumerate(self.blocks):
+            if (not block.valid):
+                self.move_to_end_of_tag_queue(tag)
+                return block_idx, None
+
+        # Find LRU block
+        lru_tag = self.tag_queue[0]
+        for block_idx, block in enumerate(self.blocks):
+            if block.tag == lru_tag:
+                self.move_to_end_of_tag_queue(tag, lru_tag)
+                return block_idx, lru_tag
+
+    def move_to_end_of_tag_queue(self, tag, lru_tag=None):
+        tag_queue = self.tag_queue
+        invalid_tag = -1
+
+        if (tag in tag_queue):
+            tag_queue.remove(tag)
+
+        elif invalid_tag in tag_queue:
+            tag_queue.remove(invalid_tag)
+
+        elif lru_tag is not None:
+            tag_queue.remove(lru_tag)
+
+        else:
+            tag_queue.remove(tag)
+
+        tag_queue.append(tag)
+        self.mru = tag
+        return tag_queue
 # ================================================
 
 
-class Cache:
-    def __init__(self, num_sets, associativity, cache_block_size):
-        self.write_through = False
-        self.sets = [CacheSet(cache_block_size, associativity)
-                     for i in range(num_sets)]
-        memory_size_bits = logb2(MEMORY_SIZE)
-        self.cache_size_bits = logb2(CACHE_SIZE)
-        self.cache_block_size_bits = logb2(cache_block_size)
-        self.index_length = logb2(num_sets)
-        self.block_offset_length = logb2(cache_block_size)
+class LruCacheSet:
+    # Same interface as CacheSet with O(1) hit, fill and evict: ways maps
+    # tag -> block index in LRU order (least recently used first)
+    def __init__(self, cache_block_size, associativity):
+        self.blocks = [CacheBlock(cache_block_size)
+                       for i in range(associativity)]
+        self.ways = OrderedDict()
+        # Invalid blocks, popped lowest index first like CacheSet fills them
+        self.free_ways = list(range(associativity - 1, -1, -1))
+        self.mru = -1
+
+    @property
+    def tag_queue(self):
+        return [-1] * len(self.free_ways) + list(self.ways)
+
+    def lookup(self, tag):
+        block_idx = self.ways.get(tag)
+        if block_idx is not None:
+            self.ways.move_to_end(tag)
+            self.mru = tag
+        return block_idx
+
+    def allocate(self, tag):
+        if self.free_ways:
+            block_idx = self.free_ways.pop()
+            lru_tag = None
+        else:
+            lru_tag, block_idx = self.ways.popitem(last=False)
+        self.ways[tag] = block_idx
+        self.mru = tag
+        return block_idx, lru_tag
+# ================================================
 
-        print('-----------------------------')
-        print(f'cache size = {CACHE_SIZE}')
-        print(f'block size = {CACHE_BLOCK_SIZE}')
-        num_blocks = CACHE_SIZE // CACHE_BLOCK_SIZE
-        print(f'#blocks = {num_blocks}')
-        print(f'#sets = {num_sets}')
-        print(f'associativity = {ASSOCIATIVITY}')
 
-        print(
-            f'tag length = {logb2(MEMORY_SIZE // (CACHE_SIZE // ASSOCIATIVITY))}')
-        if (WRITE_BACK):
-            print('write back')
-        print('-----------------------------')
+class ReplacementPolicy:
+    # Replacement state for one set: Cache calls touch() on a hit, victim() when
+    # the set is full and fill() after a block is (re)filled
+    name = 'policy'
 
-    def compute_offset_index_tag(self, address):
-        # Takes the num bits that the Offset takes up
-        index_shift = logb2(CACHE_BLOCK_SIZE)
+    def __init__(self, associativity, rng):
+        self.associativity = associativity
 
-        # Takes the number of bits that the block index, plus the block offset take up
-        tag_shift = index_shift + \
-            logb2((CACHE_SIZE // CACHE_BLOCK_SIZE) // ASSOCIATIVITY)
+    def touch(self, way):
+        pass
 
-        offset = (address) & (CACHE_BLOCK_SIZE - 1)
-        index = (address >> index_shift) & (CACHE_SIZE // CACHE_BLOCK_SIZE - 1)
+    def fill(self, way):
+        pass
 
-        max_tag_val = MEMORY_SIZE // CACHE_SIZE
-        tag = (address >> tag_shift) & (max_tag_val - 1)
+    def victim(self):
+        raise NotImplementedError
 
-        return offset, index, tag
+    def metadata_bits(self):
+        # Replacement metadata kept per set, in bits
+        return 0
 
-    def read_word(self, address):
-        self.worker_algo(address, read_flag=True)
 
-    def write_word(self, address, word):
-        self.worker_algo(address, read_flag=False, word=word)
+class LruPolicy(ReplacementPolicy):
+    name = 'lru'
 
-    def worker_algo(self, address, read_flag, word=None):
+    def __init__(self, associativity, rng):
+        super().__init__(associativity, rng)
+        self.clock = 0
+        self.last_used = [0] * associativity
 
-        # Define inner output function
-        def print_output_result(read_write, hit_miss_replace, block_index):
-            print(
-                f'{read_write} {hit_miss_replace} [addr={address} index={index} block_index={block_index} tag={tag}: word={word} ({bottom_mem_addr} - {top_mem_addr})]')
+    def touch(self, way):
+        self.clock += 1
+        self.last_used[way] = self.clock
 
-        def print_output_tag_queue():
-            tag_queue_string = ''
-            for elm in cache_set.tag_queue:
-                tag_queue_string += (str(elm) + ' ')
+    fill = touch
 
-            print(f'[ {tag_queue_string}]')
+    def victim(self):
+        return self.last_used.index(min(self.last_used))
 
-        def print_output_address_word():
-            print(
-                f'address = {address} {bin(address)[2:].zfill(logb2(MEMORY_SIZE))}; word = {word}')
-            print('')
+    def metadata_bits(self):
+        # A true LRU stack: log2(ways) bits of rank per way
+        return self.associativity * logb2(self.associativity)
 
-        def print_output_evict_tag(tag, block_index):
-            print(f'evict tag {tag} in block_index {block_index}')
 
-        def print_output_read_in_from_memory(start_addr, end_addr):
-            print(f'read in ({start_addr} - {end_addr})')
+class FifoPolicy(ReplacementPolicy):
+    name = 'fifo'
 
-        offset, index, tag = self.compute_offset_index_tag(address)
-        block_address = address // CACHE_BLOCK_SIZE
-        bottom_mem_addr = CACHE_BLOCK_SIZE * block_address
-        top_mem_addr = bottom_mem_addr + CACHE_BLOCK_SIZE - 1
+    def __init__(self, associativity, rng):
+        super().__init__(associativity, rng)
+        # Blocks fill way 0 first, so the oldest block is always at next_way
+        self.next_way = 0
 
-        cache_set = self.sets[index]
+    def victim(self):
+        way = self.next_way
+        self.next_way = (way + 1) % self.associativity
+        return way
 
-        found = False
-        block_index = 0
+    def metadata_bits(self):
+        return logb2(self.associativity)
 
-        for block_idx, block in enumerate(cache_set.blocks):
-            if (block.tag == tag) and (block.valid):
-                block_index = block_idx
-                found = True
-                break
 
-        # Cache Hit
-        if found:
-            block = cache_set.blocks[block_index]
-            block.tag = tag
-            block.valid = True
-            cache_set.tag_queue = self.move_to_end_of_tag_queue(
-                cache_set.tag_queue, tag)
-
-            if read_flag:
-                word = self.read_from_cache(block, offset)
-                print_output_result('read', 'hit', block_index)
-                print_output_tag_queue()
-                print_output_address_word()
+class RandomPolicy(ReplacementPolicy):
+    name = 'random'
+
+    def __init__(self, associativity, rng):
+        super().__init__(associativity, rng)
+        self.rng = rng
+
+    def victim(self):
+        return self.rng.randrange(self.associativity)
+
+
+class TreePlruPolicy(ReplacementPolicy):
+    # Binary tree of associativity - 1 bits packed in one int, node i's children
+    # are 2i and 2i + 1 (root 1); a bit points towards the half to evict next
+    name = 'plru'
 
+    def __init__(self, associativity, rng):
+        super().__init__(associativity, rng)
+        assert associativity & (associativity - 1) == 0, 'tree PLRU needs a power of 2 ways'
+        self.levels = logb2(associativity)
+        self.bits = 0
+
+    def touch(self, way):
+        node = 1
+        for level in range(self.levels - 1, -1, -1):
+            direction = (way >> level) & 1
+            # Point away from the half just used
+            if direction:
+                self.bits &= ~(1 << node)
             else:
-                self.write_to_cache(block, word, address,
-                                    offset, bottom_mem_addr, top_mem_addr)
-                print_output_result('write', 'hit', block_index)
-                print_output_tag_queue()
-                print_output_address_word()
+                self.bits |= 1 << node
+            node = 2 * node + direction
+
+    fill = touch
+
+    def victim(self):
+        node = 1
+        way = 0
+        for level in range(self.levels):
+            direction = (self.bits >> node) & 1
+            way = 2 * way + direction
+            node = 2 * node + direction
+        return way
+
+    def metadata_bits(self):
+        return self.associativity - 1
+
 
-        # Cache Miss
+class LfuPolicy(ReplacementPolicy):
+    # 8 bit saturating use counters, ties go to the lowest way
+    name = 'lfu'
+    COUNTER_MAX = 255
+
+    def __init__(self, associativity, rng):
+        super().__init__(associativity, rng)
+        self.counts = [0] * associativity
+
+    def touch(self, way):
+        if self.counts[way] < self.COUNTER_MAX:
+            self.counts[way] += 1
+
+    def fill(self, way):
+        self.counts[way] = 1
+
+    def victim(self):
+        return self.counts.index(min(self.counts))
+
+    def metadata_bits(self):
+        return self.associativity * 8
+
+
+class SrripPolicy(ReplacementPolicy):
+    # Static re-reference interval prediction with 2 bit RRPVs: hits predict
+    # near re-reference (0), fills a long one (max - 1), max is evicted first
+    name = 'srrip'
+    RRPV_BITS = 2
+    RRPV_MAX = 3
+
+    def __init__(self, associativity, rng):
+        super().__init__(associativity, rng)
+        self.rng = rng
+        self.rrpv = [self.RRPV_MAX] * associativity
+
+    def touch(self, way):
+        self.rrpv[way] = 0
+
+    def fill(self, way):
+        self.rrpv[way] = self.RRPV_MAX - 1
+
+    def victim(self):
+        rrpv = self.rrpv
+        while True:
+            if self.RRPV_MAX in rrpv:
+                return rrpv.index(self.RRPV_MAX)
+            # Age every block until one reaches the distant interval
+            age = self.RRPV_MAX - max(rrpv)
+            for way in range(self.associativity):
+                rrpv[way] += age
+
+    def metadata_bits(self):
+        return self.associativity * self.RRPV_BITS
+
+
+class BrripPolicy(SrripPolicy):
+    # Bimodal RRIP: fills predict a distant re-reference except 1 in 32
+    name = 'brrip'
+    LONG_FILL_ODDS = 32
+
+    def fill(self, way):
+        if self.rng.randrange(self.LONG_FILL_ODDS) == 0:
+            self.rrpv[way] = self.RRPV_MAX - 1
         else:
-            # Check if we have an invalid block to use
-            invalid_block_present = False
-            block_index = None
-
-            for block_idx, block in enumerate(cache_set.blocks):
-                if (not block.valid):
-                    invalid_block_present = True
-                    block_index = block_idx
-                    break
-
-            # We have an empty block to use
-            if (invalid_block_present):
-                block = cache_set.blocks[block_index]
-
-                block.tag = tag
-                block.valid = True
-                cache_set.tag_queue = self.move_to_end_of_tag_queue(
-                    cache_set.tag_queue, tag)
-
-                if read_flag:
-                    block.read_from_memory(
-                        bottom_mem_addr, top_mem_addr)
-                    word = self.read_from_cache(
-                        block, offset)
-                    print_output_result('read', 'miss', block_index)
-                    print_output_tag_queue()
-                    print_output_address_word()
+            self.rrpv[way] = self.RRPV_MAX
 
-                else:
-                    self.write_to_cache(block, word, address,
-                                        offset, bottom_mem_addr, top_mem_addr)
-                    print_output_result('write', 'miss', block_index)
-                    print_output_tag_queue()
-                    print_output_address_word()
 
-            # Else we must evict a cache block
-            else:
-                # Find LRU block
-                lru_tag = cache_set.tag_queue[0]
-                block = None
-
-                for block_idx, set_block in enumerate(cache_set.blocks):
-                    if set_block.tag == lru_tag:
-                        block = set_block
-                        block_index = block_idx
-                        break
-
-                block.tag = tag
-                block.valid = True
-                cache_set.tag_queue = self.move_to_end_of_tag_queue(
-                    cache_set.tag_queue, tag, lru_tag)
-                block.read_from_memory(
-                    bottom_mem_addr, top_mem_addr)
-
-                if (block.dirty):
-                    self.write_to_memory(block, bottom_mem_addr, top_mem_addr)
-
-                if (read_flag):
-                    block.read_from_memory(bottom_mem_addr, top_mem_addr)
-                    word = self.read_from_cache(
-                        block, offset)
-                    print_output_result('read', 'miss + replace', block_index)
-                    print_output_read_in_from_memory(
-                        bottom_mem_addr, top_mem_addr)
-                    print_output_evict_tag(lru_tag, block_index)
-                    print_output_tag_queue()
-                    print_output_address_word()
-
-                # We know write allocate, so read in, write the value to block-- check for write-back
-                else:
-                    block.read_from_memory(
-                        bottom_mem_addr, top_mem_addr)
-                    self.write_to_cache(block, word, address,
-                                        offset, bottom_mem_addr, top_mem_addr)
-                    print_output_result('write', 'miss + replace', block_index)
-                    print_output_read_in_from_memory(
-                        bottom_mem_addr, top_mem_addr)
-                    print_output_evict_tag(lru_tag, block_index)
-                    print_output_tag_queue()
-                    print_output_address_word()
-
-    def move_to_end_of_tag_queue(self, tag_queue: list[int], tag, lru_tag=None):
-        invalid_tag = -1
+POLICIES = {policy.name: policy for policy in
+            (LruPolicy, FifoPolicy, RandomPolicy, TreePlruPolicy, LfuPolicy, SrripPolicy, BrripPolicy)}
 
-        if (tag in tag_queue):
-            tag_queue.remove(tag)
 
-        elif invalid_tag in tag_queue:
-            tag_queue.remove(invalid_tag)
+class PolicyCacheSet:
+    # Same interface as CacheSet, with victim selection delegated to a
+    # ReplacementPolicy. mru stays None since an MRU hit can change policy state
+    def __init__(self, cache_block_size, associativity, policy: ReplacementPolicy):
+        self.blocks = [CacheBlock(cache_block_size)
+                       for i in range(associativity)]
+        self.policy = policy
+        self.ways = {}
+        self.free_ways = list(range(associativity - 1, -1, -1))
+        self.mru = None
+
+    @property
+    def tag_queue(self):
+        return [block.tag if block.valid else -1 for block in self.blocks]
+
+    def lookup(self, tag):
+        block_idx = self.ways.get(tag)
+        if block_idx is not None:
+            self.policy.touch(block_idx)
+        return block_idx
+
+    def allocate(self, tag):
+        if self.free_ways:
+            block_idx = self.free_ways.pop()
+            evicted_tag = None
+        else:
+            block_idx = self.policy.victim()
+            evicted_tag = self.blocks[block_idx].tag
+            del self.ways[evicted_tag]
+        self.ways[tag] = block_idx
+        self.policy.fill(block_idx)
+        return block_idx, evicted_tag
+# ================================================
 
-        elif lru_tag:
-            tag_queue.remove(lru_tag)
 
+class CacheStats:
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_backs = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    def __eq__(self, other):
+        return isinstance(other, CacheStats) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return f'CacheStats({self.as_dict()})'
+
+
+class MemoryTraffic:
+    # What reaches memory: bytes moved each way, write transactions issued
+    # and stores merged into an entry already waiting in the write buffer
+    def __init__(self):
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.memory_writes = 0
+        self.coalesced_writes = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    def __repr__(self):
+        return f'MemoryTraffic({self.as_dict()})'
+
+
+class WriteBuffer:
+    # Coalescing buffer of up to depth pending block writes, oldest first.
+    # Each entry is a block image plus one valid byte per word; a store to a
+    # block already queued merges into its entry, and queueing a new block in
+    # a full buffer drains the oldest entry to memory.
+    def __init__(self, depth, cache_block_size, memory, traffic: MemoryTraffic):
+        self.depth = depth
+        self.block_size = cache_block_size
+        self.block_mask = ~(cache_block_size - 1)
+        self.memory = memory
+        self.memory_view = memoryview(memory)
+        self.traffic = traffic
+        self.entries = OrderedDict()
+
+    def write(self, address, data):
+        # data is whole words starting at address, within one block
+        if not self.depth:
+            # No buffering, the store goes straight to memory
+            self.memory_view[address: address + len(data)] = data
+            self.traffic.bytes_written += len(data)
+            self.traffic.memory_writes += 1
+            return
+
+        base = address & self.block_mask
+        offset = address - base
+        entry = self.entries.get(base)
+        if entry is None:
+            entry = self.entries[base] = (bytearray(self.block_size), bytearray(self.block_size // 4))
         else:
-            tag_queue.remove(tag)
+            self.traffic.coalesced_writes += 1
+        block, valid = entry
+        block[offset: offset + len(data)] = data
+        valid[offset // 4: (offset + len(data)) // 4] = b'\x01' * (len(data) // 4)
+
+        if len(self.entries) > self.depth:
+            self.drain_entry(*self.entries.popitem(last=False))
+
+    def drain_entry(self, base, entry):
+        block, valid = entry
+        memory = self.memory
+        words = valid.count(1)
+        if words == len(valid):
+            memory[base: base + self.block_size] = block
+        else:
+            for word_idx, is_valid in enumerate(valid):
+                if is_valid:
+                    offset = word_idx * 4
+                    memory[base + offset: base + offset + 4] = block[offset: offset + 4]
+        self.traffic.bytes_written += words * 4
+        self.traffic.memory_writes += 1
+
+    def drain_block(self, address):
+        # A fill must see stores still waiting for its block
+        entry = self.entries.pop(address & self.block_mask, None)
+        if entry is not None:
+            self.drain_entry(address & self.block_mask, entry)
+
+    def drain(self):
+        while self.entries:
+            self.drain_entry(*self.entries.popitem(last=False))
+# ================================================
 
-        tag_queue.append(tag)
-        return tag_queue
 
-    def write_back(self, block: CacheBlock):
-        pass
+class Cache:
+    # log receives one string per output line (e.g. print), or None to only
+    # collect the counters in self.stats
+    # policy is a ReplacementPolicy class (or a POLICIES name) for PolicyCacheSets,
+    # seeded with seed; otherwise the sets are set_class (LRU).
+    # storage='buffer' keeps all block data in one preallocated buffer
+    # memory is the backing store, a zeroed bytearray of config.memory_size by default
+    def __init__(self, config: CacheConfig, log=print, set_class=CacheSet,
+                 policy=None, seed=0, storage='blocks', memory=None):
+        num_sets = config.num_sets
+        associativity = config.associativity
+        cache_block_size = config.cache_block_size
+
+        self.config = config
+        self.write_through = not config.write_back
+        self.allocate_writes = config.write_allocate
+        self.memory = bytearray(config.memory_size) if memory is None else memory
+        self.memory_view = memoryview(self.memory)
+        self.log = log
+        self.stats = CacheStats()
+        self.traffic = MemoryTraffic()
+        self.write_buffer = WriteBuffer(config.write_buffer_depth, cache_block_size, self.memory, self.traffic)
+        if policy is None:
+            self.sets = [set_class(cache_block_size, associativity)
+                         for i in range(num_sets)]
+        else:
+            policy = POLICIES.get(policy, policy)
+            rng = random.Random(seed)
+            self.sets = [PolicyCacheSet(cache_block_size, associativity, policy(associativity, rng))
+                         for i in range(num_sets)]
+
+        if storage == 'buffer':
+            # Block (set, way) lives at ((set * associativity) + way) * block size
+            self.storage = memoryview(bytearray(num_sets * associativity * cache_block_size))
+            for set_idx, cache_set in enumerate(self.sets):
+                cache_set.blocks = [BufferCacheBlock(self.storage, (set_idx * associativity + way) * cache_block_size,
+                                                     cache_block_size)
+                                    for way in range(associativity)]
+
+        # Address split, copied from the config for the per-access paths
+        self.block_size = cache_block_size
+        self.offset_mask = config.offset_mask
+        self.index_shift = config.index_shift
+        self.index_mask = config.index_mask
+        self.tag_shift = config.tag_shift
+
+        if log is None:
+            return
+
+        log('-----------------------------')
+        log(f'cache size = {config.cache_size}')
+        log(f'block size = {config.cache_block_size}')
+        log(f'#blocks = {config.num_blocks}')
+        log(f'#sets = {num_sets}')
+        log(f'associativity = {associativity}')
+
+        log(f'tag length = {config.tag_length}')
+        if (config.write_back):
+            log('write back')
+        if not config.write_allocate:
+            log('no write allocate')
+        if config.write_buffer_depth:
+            log(f'write buffer depth = {config.write_buffer_depth}')
+        log('-----------------------------')
 
-    def write_allocate(self, block: CacheBlock):
-        self.read_back(block)
-        # write the value to the block
-        # If write through
-        #   self.write_back(block)
+    def compute_offset_index_tag(self, address):
+        offset = address & self.offset_mask
+        index = (address >> self.index_shift) & self.index_mask
+        tag = address >> self.tag_shift
 
-    def read_back(self, block: CacheBlock):
-        pass
+        return offset, index, tag
+
+    def read_word(self, address):
+        return self.worker_algo(address, read_flag=True)
 
-    def check_dirty(self, block: CacheBlock):
+    def write_word(self, address, word):
+        self.worker_algo(address, read_flag=False, word=word)
+
+    def worker_algo(self, address, read_flag, word=None):
+        offset, index, tag = self.compute_offset_index_tag(address)
+        bottom_mem_addr = address & ~self.offset_mask
+        top_mem_addr = bottom_mem_addr + self.block_size - 1
+
+        cache_set = self.sets[index]
+        stats = self.stats
+        if read_flag:
+            stats.reads += 1
+        else:
+            stats.writes += 1
+
+        evicted_tag = None
+        block_index = cache_set.lookup(tag)
+
+        # Cache Hit
+        if block_index is not None:
+            stats.hits += 1
+            hit_miss_replace = 'hit'
+
+        # Cache Miss, reads and write-allocate writes fill the block
+        elif read_flag or self.allocate_writes:
+            stats.misses += 1
+            block_index, evicted_tag = cache_set.allocate(tag)
+
+            # We had an empty block to use
+            if evicted_tag is None:
+                hit_miss_replace = 'miss'
+
+            # Else we evicted the LRU block
+            else:
+                hit_miss_replace = 'miss + replace'
+                self.evict(cache_set.blocks[block_index], index, evicted_tag)
+
+            self.write_allocate(cache_set.blocks[block_index], tag, bottom_mem_addr)
+
+        # Write miss without allocation, the word goes around the cache
+        else:
+            stats.misses += 1
+            self.write_buffer.write(address, WORD.pack(word & MAX_WORD))
+            if self.log is not None:
+                self.log_access('write', 'miss (no allocate)', address, index, None, tag, word,
+                                bottom_mem_addr, top_mem_addr, cache_set, None)
+            return word
+
+        block = cache_set.blocks[block_index]
+        if read_flag:
+            word = self.read_from_cache(block, offset)
+        else:
+            self.write_to_cache(block, word, address,
+                                offset, bottom_mem_addr, top_mem_addr)
+
+        if self.log is not None:
+            self.log_access('read' if read_flag else 'write', hit_miss_replace,
+                            address, index, block_index, tag, word,
+                            bottom_mem_addr, top_mem_addr, cache_set, evicted_tag)
+
+        return word
+
+    def evict(self, block: CacheBlock, index, tag):
+        # Dirty data belongs to the evicted tag's address range, not the incoming one
+        self.stats.evictions += 1
+        self.check_dirty(block, (tag << self.tag_shift) | (index << self.index_shift))
+
+    def log_access(self, read_write, hit_miss_replace, address, index, block_index, tag, word,
+                   bottom_mem_addr, top_mem_addr, cache_set, evicted_tag):
+        log = self.log
+        log(f'{read_write} {hit_miss_replace} [addr={address} index={index} block_index={block_index} tag={tag}: word={word} ({bottom_mem_addr} - {top_mem_addr})]')
+
+        if evicted_tag is not None:
+            log(f'read in ({bottom_mem_addr} - {top_mem_addr})')
+            log(f'evict tag {evicted_tag} in block_index {block_index}')
+
+        tag_queue_string = ''
+        for elm in cache_set.tag_queue:
+            tag_queue_string += (str(elm) + ' ')
+        log(f'[ {tag_queue_string}]')
+
+        log(f'address = {address} {bin(address)[2:].zfill(self.config.memory_size_bits)}; word = {word}')
+        log('')
+
+    def replay(self, accesses):
+        # accesses yields (kind, address, word). With no log, read hits on
+        # the MRU block are counted inline since they change no cache state.
+        if self.log is not None:
+            for kind, address, word in accesses:
+                self.worker_algo(address, kind != ACCESS_WRITE, word)
+            return self.stats
+
+        sets = self.sets
+        index_shift = self.index_shift
+        index_mask = self.index_mask
+        tag_shift = self.tag_shift
+        worker_algo = self.worker_algo
+        mru_read_hits = 0
+
+        for kind, address, word in accesses:
+            if kind != ACCESS_WRITE and sets[(address >> index_shift) & index_mask].mru == address >> tag_shift:
+                mru_read_hits += 1
+            else:
+                worker_algo(address, kind != ACCESS_WRITE, word)
+
+        self.stats.reads += mru_read_hits
+        self.stats.hits += mru_read_hits
+        return self.stats
+
+    def flush(self):
+        # Writes back every dirty block and drains the write buffer, after
+        # which memory holds every store
+        for index, cache_set in enumerate(self.sets):
+            for block in cache_set.blocks:
+                if block.valid:
+                    self.check_dirty(block, (block.tag << self.tag_shift) | (index << self.index_shift))
+        self.write_buffer.drain()
+
+    def write_back(self, block: CacheBlock, lower_addr):
+        self.write_to_memory(block, lower_addr, lower_addr + self.block_size - 1)
+        self.stats.write_backs += 1
+        block.dirty = False
+
+    def write_allocate(self, block: CacheBlock, tag, lower_addr):
+        block.tag = tag
+        block.valid = True
+        block.dirty = False
+        self.read_back(block, lower_addr)
+
+    def read_back(self, block: CacheBlock, lower_addr):
+        self.write_buffer.drain_block(lower_addr)
+        block.read_from_memory(self.memory_view, lower_addr, lower_addr + self.block_size - 1)
+        self.traffic.bytes_read += self.block_size
+
+    def check_dirty(self, block: CacheBlock, lower_addr):
         if (block.dirty):
-            self.write_back(block)
+            self.write_back(block, lower_addr)
 
     def read_from_cache(self, block: CacheBlock, offset: int):
         # Do the work to read the word
@@ -282,20 +749,624 @@ class Cache:
 
     def write_to_cache(self, block: CacheBlock, word: str, address: int, offset, lower_addr, top_addr):
         block.write_from_offset(word, offset)
-        if (not WRITE_BACK):
-            # do the word to write to memory
-            self.write_to_memory(block, lower_addr, top_addr)
+        if (self.write_through):
+            # only the stored word goes to memory
+            self.write_buffer.write(address, WORD.pack(word & MAX_WORD))
 
         else:
             block.dirty = True
 
     def write_to_memory(self, block: CacheBlock, lower_addr, top_addr):
-        # MAX_BYTE_NUM = 255  # 2^8 - 1
-        # memory[address + 3] = (block.data >> 24) & MAX_BYTE_NUM
-        # memory[address + 2] = (block.data >> 16) & MAX_BYTE_NUM
-        # memory[address + 1] = (block.data >> 8) & MAX_BYTE_NUM
-        # memory[address] = (block.data) & MAX_BYTE_NUM
-        memory[lower_addr: top_addr + 1] = block.data
+        # Whole block, through the write buffer
+        self.write_buffer.write(lower_addr, block.data)
+
+# ============================================================
+# Trace files
+#
+# Text traces have one access per line: "r <address>", "w <address> <word>" or
+# "i <address>" (instruction fetch), numbers in decimal or 0x hex, "#" starts
+# a comment. Binary traces start with TRACE_MAGIC followed by packed
+# TRACE_RECORDs of (kind, address, word). Readers yield the same tuples.
+
+ACCESS_READ = 0
+ACCESS_WRITE = 1
+ACCESS_FETCH = 2
+ACCESS_KINDS = {'r': ACCESS_READ, 'w': ACCESS_WRITE, 'i': ACCESS_FETCH}
+
+TRACE_MAGIC = b'CTRC'
+TRACE_RECORD = struct.Struct('<BQI')
+
+
+def read_text_trace(path):
+    with open(path) as file:
+        for line in file:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            kind = ACCESS_KINDS[fields[0]]
+            word = int(fields[2], 0) if kind == ACCESS_WRITE else None
+            yield kind, int(fields[1], 0), word
+
+
+def read_binary_trace(path, chunk_records=65536):
+    # Reads chunk_records at a time so memory stays flat for any trace size
+    with open(path, 'rb') as file:
+        if file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f'{path} is not a binary cache trace')
+        while True:
+            chunk = file.read(TRACE_RECORD.size * chunk_records)
+            if not chunk:
+                break
+            yield from TRACE_RECORD.iter_unpack(chunk)
+
+
+def read_trace(path):
+    with open(path, 'rb') as file:
+        binary = file.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+    return read_binary_trace(path) if binary else read_text_trace(path)
+
+
+def write_binary_trace(path, accesses):
+    with open(path, 'wb') as file:
+        file.write(TRACE_MAGIC)
+        for kind, address, word in accesses:
+            file.write(TRACE_RECORD.pack(kind, address, word or 0))
+
+
+def replay_trace(path, config: CacheConfig, log=None):
+    c = Cache(config, log)
+    return c.replay(read_trace(path))
+
+
+def compare_policies(accesses, config: CacheConfig, policies=POLICIES, seed=0):
+    # Feeds every access to one silent Cache per policy in a single pass over
+    # the trace. Returns {name: (stats, metadata bits per set)}.
+    caches = {name: Cache(config, log=None, policy=name, seed=seed)
+              for name in policies}
+    workers = [c.worker_algo for c in caches.values()]
+
+    for kind, address, word in accesses:
+        read_flag = kind != ACCESS_WRITE
+        for worker_algo in workers:
+            worker_algo(address, read_flag, word)
+
+    return {name: (c.stats, c.sets[0].policy.metadata_bits()) for name, c in caches.items()}
+
+# ============================================================
+# Tag-only cache
+#
+# Hit-rate studies don't need data values, so TagCache keeps only packed
+# per-block metadata (tags, dirty bits, LRU stamps) and never touches memory.
+# Counters match an LRU Cache with the same write policies for the same trace,
+# and addresses can be as wide as needed since no backing memory exists.
+
+
+class TagCache:
+    def __init__(self, config: CacheConfig):
+        num_sets = config.num_sets
+        associativity = config.associativity
+        num_blocks = num_sets * associativity
+        self.config = config
+        self.associativity = associativity
+        self.block_shift = config.block_offset_length
+        self.index_mask = config.index_mask
+        self.write_back = config.write_back
+        self.write_allocate = config.write_allocate
+        self.stats = CacheStats()
+
+        # Block slot (set * associativity + way) arrays
+        self.blocks = array('q', [-1]) * num_blocks
+        self.dirty = bytearray(num_blocks)
+        self.stamps = array('Q', [0]) * num_blocks
+        # Valid blocks per set, sets fill their ways in order
+        self.valid = array('I', [0]) * num_sets
+        # Block address -> slot for every valid block
+        self.slots = {}
+        self.clock = 0
+
+    def access(self, address, is_write=False):
+        self.replay(((ACCESS_WRITE if is_write else ACCESS_READ, address, None),))
+
+    def replay(self, accesses):
+        blocks = self.blocks
+        dirty = self.dirty
+        stamps = self.stamps
+        valid = self.valid
+        slots = self.slots
+        block_shift = self.block_shift
+        index_mask = self.index_mask
+        associativity = self.associativity
+        write_back = self.write_back
+        write_allocate = self.write_allocate
+        clock = self.clock
+        reads = writes = hits = misses = evictions = write_backs = 0
+
+        for kind, address, word in accesses:
+            clock += 1
+            block = address >> block_shift
+            is_write = kind == ACCESS_WRITE
+            if is_write:
+                writes += 1
+            else:
+                reads += 1
+
+            slot = slots.get(block)
+            if slot is not None:
+                hits += 1
+                stamps[slot] = clock
+                if is_write and write_back:
+                    dirty[slot] = 1
+                continue
+
+            misses += 1
+            # Write misses without allocation go around the cache
+            if is_write and not write_allocate:
+                continue
+
+            index = block & index_mask
+            base = index * associativity
+            if valid[index] < associativity:
+                slot = base + valid[index]
+                valid[index] += 1
+            else:
+                # Evict the least recently used way
+                set_stamps = stamps[base: base + associativity]
+                slot = base + set_stamps.index(min(set_stamps))
+                evictions += 1
+                if dirty[slot]:
+                    write_backs += 1
+                del slots[blocks[slot]]
+
+            blocks[slot] = block
+            dirty[slot] = is_write and write_back
+            stamps[slot] = clock
+            slots[block] = slot
+
+        self.clock = clock
+        stats = self.stats
+        stats.reads += reads
+        stats.writes += writes
+        stats.hits += hits
+        stats.misses += misses
+        stats.evictions += evictions
+        stats.write_backs += write_backs
+        return stats
+
+# ============================================================
+# Stack distance (Mattson) analysis
+#
+# For a fixed block size and set count, an access hits in an LRU cache of
+# associativity A iff fewer than A distinct blocks of its set were touched
+# since its previous access (its stack distance). One pass over the trace
+# therefore gives the hit ratio of every associativity at once.
+
+
+class FenwickTree:
+    # Prefix sums over per-access markers, grows by doubling as accesses arrive
+    def __init__(self, size=1024):
+        self.tree = [0] * (size + 1)
+
+    def add(self, i, delta):
+        i += 1
+        while i >= len(self.tree):
+            # Doubling a power-of-two tree only needs the new root (the old total)
+            size = len(self.tree) - 1
+            self.tree.extend([0] * size)
+            self.tree[2 * size] = self.tree[size]
+        tree = self.tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, i):
+        # Sum of entries [0, i)
+        total = 0
+        tree = self.tree
+        i = min(i, len(tree) - 1)
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+
+class StackDistanceProfile:
+    def __init__(self, num_sets, cache_block_size):
+        self.num_sets = num_sets
+        self.cache_block_size = cache_block_size
+        self.accesses = 0
+        self.cold_misses = 0
+        self.histogram = {}
+
+    def hits(self, associativity):
+        return sum(count for distance, count in self.histogram.items() if distance < associativity)
+
+    def hit_ratio(self, associativity):
+        return self.hits(associativity) / self.accesses if self.accesses else 0.0
+
+    def report(self, max_associativity=None):
+        if max_associativity is None:
+            max_associativity = max(self.histogram, default=0) + 1
+        lines = ['associativity  cache size      hits    misses  hit ratio']
+        associativity = 1
+        while associativity <= max_associativity:
+            hits = self.hits(associativity)
+            cache_size = self.num_sets * associativity * self.cache_block_size
+            lines.append(f'{associativity:>13} {cache_size:>11} {hits:>9} {self.accesses - hits:>9} '
+                         f'{self.hit_ratio(associativity):>10.4f}')
+            associativity *= 2
+        return '\n'.join(lines)
+
+
+def stack_distances(accesses, num_sets, cache_block_size):
+    # accesses yields (kind, address, word), every kind allocates
+    block_shift = logb2(cache_block_size)
+    index_mask = num_sets - 1
+
+    profile = StackDistanceProfile(num_sets, cache_block_size)
+    histogram = profile.histogram
+    trees = [FenwickTree() for i in range(num_sets)]
+    last_access = [{} for i in range(num_sets)]
+    times = [0] * num_sets
+    cold_misses = 0
+    count = 0
+
+    for _, address, _ in accesses:
+        count += 1
+        block_address = address >> block_shift
+        index = block_address & index_mask
+        tree = trees[index]
+        seen = last_access[index]
+        now = times[index]
+        times[index] = now + 1
+
+        last = seen.get(block_address)
+        if last is None:
+            cold_misses += 1
+        else:
+            # Distinct blocks touched since last = markers after it
+            distance = len(seen) - tree.prefix_sum(last + 1)
+            histogram[distance] = histogram.get(distance, 0) + 1
+            tree.add(last, -1)
+
+        tree.add(now, 1)
+        seen[block_address] = now
+
+    profile.accesses = count
+    profile.cold_misses = cold_misses
+    return profile
+
+
+def stack_distance_trace(path, num_sets, cache_block_size):
+    return stack_distances(read_trace(path), num_sets, cache_block_size)
+
+# ============================================================
+# Multi-level hierarchy
+#
+# Tag-level model of L1I/L1D -> L2 -> L3 -> DRAM with write-back,
+# write-allocate levels sharing one block size. Each set is an OrderedDict of
+# block address -> dirty in LRU order, so an access only moves dict entries.
+# inclusion is 'inclusive' (evicting from a lower level back-invalidates the
+# levels above), 'exclusive' (lower levels only hold victims of the level
+# above) or 'nine' (neither enforced).
+
+
+class HierarchyLevel:
+    def __init__(self, name, cache_size, associativity, latency, cache_block_size=CACHE_BLOCK_SIZE):
+        num_sets = cache_size // cache_block_size // associativity
+        self.name = name
+        self.associativity = associativity
+        self.latency = latency
+        self.cache_block_size = cache_block_size
+        self.index_mask = num_sets - 1
+        self.sets = [OrderedDict() for i in range(num_sets)]
+        self.stats = CacheStats()
+        self.back_invalidations = 0
+
+    def lookup(self, block, is_write):
+        cache_set = self.sets[block & self.index_mask]
+        if block not in cache_set:
+            return False
+        cache_set.move_to_end(block)
+        if is_write:
+            cache_set[block] = True
+        return True
+
+    def contains(self, block):
+        return block in self.sets[block & self.index_mask]
+
+    def insert(self, block, dirty):
+        # Returns the (block, dirty) pair evicted to make room, or None
+        cache_set = self.sets[block & self.index_mask]
+        victim = None
+        if len(cache_set) >= self.associativity:
+            victim = cache_set.popitem(last=False)
+            self.stats.evictions += 1
+        cache_set[block] = dirty
+        return victim
+
+    def remove(self, block):
+        # Returns the removed block's dirty bit, or None if it was not present
+        return self.sets[block & self.index_mask].pop(block, None)
+
+    def mark_dirty(self, block):
+        cache_set = self.sets[block & self.index_mask]
+        if block in cache_set:
+            cache_set[block] = True
+            return True
+        return False
+
+
+class CacheHierarchy:
+    INCLUSION_POLICIES = ('inclusive', 'exclusive', 'nine')
+
+    # l1i may be None for a unified L1, lower_levels is [L2, L3, ...]
+    def __init__(self, l1d, lower_levels=(), l1i=None, memory_latency=100, inclusion='nine'):
+        assert inclusion in self.INCLUSION_POLICIES, f'inclusion must be one of {self.INCLUSION_POLICIES}'
+        levels = [level for level in [l1i, l1d, *lower_levels] if level is not None]
+        assert len({level.cache_block_size for level in levels}) == 1, 'levels must share a block size'
+
+        self.l1i = l1i
+        self.l1d = l1d
+        self.levels = levels
+        self.inclusion = inclusion
+        self.memory_latency = memory_latency
+        self.block_shift = logb2(l1d.cache_block_size)
+        # Lookup path for data accesses and for instruction fetches
+        self.data_path = (l1d, *lower_levels)
+        self.fetch_path = (l1i or l1d, *lower_levels)
+        # Levels above each level, for inclusive back-invalidation
+        first_levels = levels[:len(levels) - len(lower_levels)]
+        self.upper = {level: [] for level in first_levels}
+        for depth, level in enumerate(lower_levels):
+            self.upper[level] = first_levels + list(lower_levels[:depth])
+
+        self.accesses = 0
+        self.total_latency = 0
+        self.memory_reads = 0
+        self.memory_writes = 0
+
+    def access(self, address, is_write=False, instruction=False):
+        # Returns the latency of this access in cycles
+        block = address >> self.block_shift
+        path = self.fetch_path if instruction else self.data_path
+
+        latency = 0
+        hit_depth = len(path)
+        for depth, level in enumerate(path):
+            latency += level.latency
+            stats = level.stats
+            if is_write and depth == 0:
+                stats.writes += 1
+            else:
+                stats.reads += 1
+            if level.lookup(block, is_write and depth == 0):
+                stats.hits += 1
+                hit_depth = depth
+                break
+            stats.misses += 1
+        else:
+            latency += self.memory_latency
+            self.memory_reads += 1
+
+        if self.inclusion == 'exclusive':
+            # The block moves up into L1 and leaves the level it was found in
+            if hit_depth > 0:
+                dirty = path[hit_depth].remove(block) if hit_depth < len(path) else False
+                self.fill(path, 0, block, bool(dirty) or is_write)
+        else:
+            # Fill bottom up so an inclusive lower level never lacks a block above it
+            for depth in range(hit_depth - 1, -1, -1):
+                self.fill(path, depth, block, is_write and depth == 0)
+
+        self.accesses += 1
+        self.total_latency += latency
+        return latency
+
+    def fill(self, path, depth, block, dirty):
+        level = path[depth]
+        victim = level.insert(block, dirty)
+        if victim is None:
+            return
+        victim_block, victim_dirty = victim
+
+        if self.inclusion == 'inclusive':
+            for upper in self.upper[level]:
+                upper_dirty = upper.remove(victim_block)
+                if upper_dirty is not None:
+                    upper.back_invalidations += 1
+                    victim_dirty = victim_dirty or upper_dirty
+
+        if victim_dirty:
+            level.stats.write_backs += 1
+
+        if self.inclusion == 'exclusive' and depth + 1 < len(path):
+            self.fill(path, depth + 1, victim_block, victim_dirty)
+        elif victim_dirty:
+            self.write_back(path, depth + 1, victim_block)
+
+    def write_back(self, path, depth, block):
+        # Dirty data goes to the first lower level holding the block, else DRAM
+        for level in path[depth:]:
+            if level.mark_dirty(block):
+                return
+        self.memory_writes += 1
+
+    def replay(self, accesses):
+        access = self.access
+        for kind, address, word in accesses:
+            access(address, kind == ACCESS_WRITE, kind == ACCESS_FETCH)
+        return self
+
+    def amat(self):
+        return self.total_latency / self.accesses if self.accesses else 0.0
+
+    def report(self):
+        lines = [f'{"level":>6} {"reads":>9} {"writes":>9} {"hits":>9} {"misses":>9} {"hit ratio":>9} '
+                 f'{"evictions":>9} {"wbacks":>9} {"back inv":>9}']
+        for level in self.levels:
+            stats = level.stats
+            probes = stats.hits + stats.misses
+            ratio = stats.hits / probes if probes else 0.0
+            lines.append(f'{level.name:>6} {stats.reads:>9} {stats.writes:>9} {stats.hits:>9} '
+                         f'{stats.misses:>9} {ratio:>9.4f} {stats.evictions:>9} {stats.write_backs:>9} '
+                         f'{level.back_invalidations:>9}')
+        lines.append(f'DRAM reads = {self.memory_reads}, DRAM writes = {self.memory_writes}')
+        lines.append(f'AMAT = {self.amat():.2f} cycles over {self.accesses} accesses ({self.inclusion})')
+        return '\n'.join(lines)
+
+# ============================================================
+# Design-space sweep
+#
+# sweep() replays one trace through a silent Cache per CacheConfig, spread over
+# a process pool. Workers mmap a binary copy of the trace rather than receiving
+# it pickled, and each point's counters are stored in cache_dir as
+# <sha256 of trace digest + point>.json so reruns only simulate new points.
+
+SWEEP_VERSION = 2  # bump when simulator changes invalidate stored results
+SWEEP_COLUMNS = ('cache_size', 'block_size', 'associativity', 'write_policy', 'write_allocate', 'write_buffer')
+
+
+def mmap_trace(path):
+    # Yields the records of a binary trace straight from a read-only mapping
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if mapped[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+            raise ValueError(f'{path} is not a binary cache trace')
+        records = memoryview(mapped)[len(TRACE_MAGIC):]
+        try:
+            yield from TRACE_RECORD.iter_unpack(records)
+        finally:
+            records.release()
+
+
+def trace_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sweep_point(config: CacheConfig):
+    return {'cache_size': config.cache_size,
+            'block_size': config.cache_block_size,
+            'associativity': config.associativity,
+            'write_policy': 'write-back' if config.write_back else 'write-through',
+            'write_allocate': config.write_allocate,
+            'write_buffer': config.write_buffer_depth}
+
+
+def simulate_point(trace_path, config: CacheConfig):
+    # Runs in a worker process, trace_path must be a binary trace. Traffic
+    # excludes blocks still dirty at the end of the trace.
+    c = Cache(config, log=None)
+    stats = c.replay(mmap_trace(trace_path)).as_dict()
+    c.write_buffer.drain()
+    stats.update(c.traffic.as_dict())
+    stats['hit_rate'] = stats['hits'] / max(stats['reads'] + stats['writes'], 1)
+    return stats
+
+
+def sweep(trace_path, configs, cache_dir=None, max_workers=None):
+    # Returns one row per config, in order: the sweep_point() columns followed
+    # by the CacheStats and MemoryTraffic counters and hit_rate
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'cachesim-sweep')
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = trace_digest(trace_path)
+
+    rows = [None] * len(configs)
+    result_paths = {}
+    for idx, config in enumerate(configs):
+        point = sweep_point(config)
+        key = json.dumps([SWEEP_VERSION, digest, config.memory_size, point], sort_keys=True)
+        path = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json')
+        try:
+            with open(path) as file:
+                rows[idx] = {**point, **json.load(file)}
+        except FileNotFoundError:
+            result_paths[idx] = path
+
+    if not result_paths:
+        return rows
+
+    with tempfile.TemporaryDirectory() as directory:
+        binary_path = trace_path
+        with open(trace_path, 'rb') as file:
+            if file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+                binary_path = os.path.join(directory, 'trace.bin')
+                write_binary_trace(binary_path, read_text_trace(trace_path))
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(simulate_point, binary_path, configs[idx]): idx
+                       for idx in result_paths}
+            for future in as_completed(futures):
+                idx = futures[future]
+                stats = future.result()
+                # Write to a temporary name first so concurrent sweeps never read a partial result
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+                with os.fdopen(fd, 'w') as file:
+                    json.dump(stats, file)
+                os.replace(tmp_path, result_paths[idx])
+                rows[idx] = {**sweep_point(configs[idx]), **stats}
+
+    return rows
+
+
+def write_sweep_table(rows, path):
+    # .json writes a list of row objects, anything else CSV
+    with open(path, 'w', newline='') as file:
+        if path.endswith('.json'):
+            json.dump(rows, file, indent=2)
+        else:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def sweep_configs(cache_sizes, block_sizes, associativities, write_backs=(True,), memory_size=MEMORY_SIZE,
+                  write_allocates=(True,), write_buffer_depths=(0,)):
+    # Every valid combination, skipping caches too small for one set
+    return [CacheConfig(cache_size, block_size, associativity, memory_size, write_back,
+                        write_allocate, write_buffer_depth)
+            for cache_size in cache_sizes
+            for block_size in block_sizes
+            for associativity in associativities
+            for write_back in write_backs
+            for write_allocate in write_allocates
+            for write_buffer_depth in write_buffer_depths
+            if cache_size >= block_size * associativity]
+
+
+def sweep_main(argv):
+    parser = argparse.ArgumentParser(prog='main.py sweep', description='Sweep cache configurations over a trace')
+    parser.add_argument('trace')
+    parser.add_argument('output', help='.csv or .json table')
+    parser.add_argument('--sizes', default='1024,2048,4096,8192')
+    parser.add_argument('--blocks', default='16,32,64')
+    parser.add_argument('--ways', default='1,2,4,8')
+    parser.add_argument('--write-policies', default='write-back',
+                        help='comma separated write-back and/or write-through')
+    parser.add_argument('--allocate', default='allocate',
+                        help='comma separated allocate and/or no-allocate, for write misses')
+    parser.add_argument('--write-buffers', default='0', help='write buffer depths')
+    parser.add_argument('--memory-size', type=int, default=MEMORY_SIZE)
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args(argv)
+
+    def ints(text):
+        return [int(value, 0) for value in text.split(',')]
+
+    configs = sweep_configs(ints(args.sizes), ints(args.blocks), ints(args.ways),
+                            [policy == 'write-back' for policy in args.write_policies.split(',')],
+                            args.memory_size,
+                            [allocate == 'allocate' for allocate in args.allocate.split(',')],
+                            ints(args.write_buffers))
+    start = time.perf_counter()
+    rows = sweep(args.trace, configs, args.cache_dir, args.workers)
+    write_sweep_table(rows, args.output)
+    print(f'{len(rows)} configurations in {time.perf_counter() - start:.2f}s -> {args.output}')
+
 
 # ============================================================
 # helper function: compute the log base 2 of the input param
@@ -310,24 +1381,23 @@ def logb2(val):
     return i-1
 
 
-def init_memory():
-    MAX_BYTE_NUM = 255  # 2^8 - 1
-    for i in range(0, MEMORY_SIZE, 4):
-        memory[i + 3] = (i >> 24) & MAX_BYTE_NUM
-        memory[i + 2] = (i >> 16) & MAX_BYTE_NUM
-        memory[i + 1] = (i >> 8) & MAX_BYTE_NUM
-        memory[i] = (i) & MAX_BYTE_NUM
+def init_memory(memory):
+    # Every word holds its own address, little-endian
+    words = array('I', range(0, len(memory), 4))
+    if sys.byteorder == 'big':
+        words.byteswap()
+    memory[:] = words.tobytes()
+    return memory
 
 
 def main():
-    init_memory()
     # test_one()
     test_two()
 
 
 def test_one():
-    num_sets = (CACHE_SIZE // CACHE_BLOCK_SIZE) // ASSOCIATIVITY
-    c = Cache(num_sets, ASSOCIATIVITY, CACHE_BLOCK_SIZE)
+    c = Cache(CacheConfig())
+    init_memory(c.memory)
     c.read_word(46916)
     c.read_word(46932)
     c.read_word(12936)
@@ -337,8 +1407,8 @@ def test_one():
 
 
 def test_two():
-    num_sets = (CACHE_SIZE // CACHE_BLOCK_SIZE) // ASSOCIATIVITY
-    c = Cache(num_sets, ASSOCIATIVITY, CACHE_BLOCK_SIZE)
+    c = Cache(CacheConfig())
+    init_memory(c.memory)
 
     c.read_word(1152)
     c.read_word(2176)
@@ -365,4 +1435,288 @@ def test_two():
     c.read_word(17532)
 
 
-main()
+def test_replay_trace():
+    # Same counters replaying a trace file silently as calling worker_algo per access
+    config = CacheConfig()
+    rng = random.Random(222)
+    accesses = []
+    for i in range(200_000):
+        # Mostly sequential words with some random jumps
+        address = (i * 4) % MEMORY_SIZE if rng.random() < 0.8 else rng.randrange(0, MEMORY_SIZE, 4)
+        if rng.random() < 0.2:
+            accesses.append((True, address, i))
+        else:
+            accesses.append((False, address, None))
+
+    expected = Cache(config, log=None)
+    for is_write, address, word in accesses:
+        expected.worker_algo(address, not is_write, word)
+
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, 'trace.txt')
+        with open(text_path, 'w') as file:
+            for is_write, address, word in accesses:
+                file.write(f'w {address} {word}\n' if is_write else f'r {address}\n')
+        bin_path = os.path.join(directory, 'trace.bin')
+        write_binary_trace(bin_path, accesses)
+
+        for path in (text_path, bin_path):
+            start = time.perf_counter()
+            stats = replay_trace(path, config)
+            elapsed = time.perf_counter() - start
+            print(f'{os.path.basename(path)}: {len(accesses) / elapsed:,.0f} accesses/sec {stats}')
+            assert stats == expected.stats
+
+
+def test_stack_distance():
+    # One stack distance pass matches a separate LRU Cache run per associativity
+    num_sets = 4
+    rng = random.Random(10)
+    accesses = [(False, rng.randrange(0, 16384, 4), None) for i in range(20_000)]
+    accesses += [(False, (i * 68) % MEMORY_SIZE, None) for i in range(5_000)]
+
+    profile = stack_distances(accesses, num_sets, CACHE_BLOCK_SIZE)
+    print(profile.report(64))
+
+    for associativity in (1, 2, 4, 8, 16, 64):
+        c = Cache(CacheConfig.from_sets(num_sets, associativity), log=None)
+        stats = c.replay(accesses)
+        assert profile.hits(associativity) == stats.hits
+
+
+def test_lru_set_scaling():
+    # CacheSet scans its blocks and tag_queue, LruCacheSet is O(1) per access
+    rng = random.Random(11)
+    accesses = [(rng.random() < 0.2, rng.randrange(0, 32768, 4), 1) for i in range(30_000)]
+
+    for num_sets, associativity in ((16, 1), (4, 4), (4, 16), (2, 64), (1, 256)):
+        results = []
+        for set_class in (CacheSet, LruCacheSet):
+            c = Cache(CacheConfig.from_sets(num_sets, associativity), log=None, set_class=set_class)
+            start = time.perf_counter()
+            stats = c.replay(accesses)
+            results.append((time.perf_counter() - start, stats))
+
+        (list_time, list_stats), (lru_time, lru_stats) = results
+        print(f'{associativity:>3}-way: CacheSet {list_time:.3f}s, LruCacheSet {lru_time:.3f}s')
+        assert list_stats == lru_stats
+
+
+def test_replacement_policies():
+    num_sets = 4
+    rng = random.Random(12)
+    accesses = [(rng.random() < 0.2, rng.randrange(0, 16384, 4), 3) for i in range(20_000)]
+
+    for associativity in (1, 2, 8):
+        config = CacheConfig.from_sets(num_sets, associativity)
+        results = compare_policies(accesses, config)
+        print(f'{associativity}-way')
+        for name, (stats, bits) in results.items():
+            print(f'  {name:>6}: {stats.hits / (stats.hits + stats.misses):.4f} hit ratio, {bits} bits/set')
+
+        # The policy LRU matches the tag_queue LRU, 2-way tree PLRU is exact LRU
+        # and with one way every policy is the same
+        expected = Cache(config, log=None).replay(accesses)
+        assert results['lru'][0] == expected
+        if associativity <= 2:
+            assert results['plru'][0] == expected
+        if associativity == 1:
+            assert all(stats == expected for stats, bits in results.values())
+
+
+def test_cache_hierarchy():
+    rng = random.Random(13)
+    accesses = []
+    for i in range(30_000):
+        if rng.random() < 0.3:
+            # Code lives above the data so L1I and L1D never share a block
+            accesses.append((ACCESS_FETCH, 49152 + (i * 4) % 8192, None))
+        else:
+            accesses.append((ACCESS_WRITE if rng.random() < 0.3 else ACCESS_READ,
+                             rng.randrange(0, MEMORY_SIZE // 4, 4), i))
+
+    # An L1 only hierarchy counts exactly like the Cache simulator
+    data_accesses = [access for access in accesses if access[0] != ACCESS_FETCH]
+    l1 = HierarchyLevel('L1D', CACHE_SIZE, ASSOCIATIVITY, 1)
+    CacheHierarchy(l1).replay(data_accesses)
+    expected = Cache(CacheConfig(), log=None).replay(data_accesses)
+    assert l1.stats == expected
+
+    for inclusion in CacheHierarchy.INCLUSION_POLICIES:
+        l1i = HierarchyLevel('L1I', 1024, 2, 1)
+        l1d = HierarchyLevel('L1D', 1024, 4, 1)
+        l2 = HierarchyLevel('L2', 4096, 4, 10)
+        l3 = HierarchyLevel('L3', 8192, 8, 30)
+        hierarchy = CacheHierarchy(l1d, [l2, l3], l1i, memory_latency=100, inclusion=inclusion)
+        hierarchy.replay(accesses)
+        print(hierarchy.report())
+
+        upper_blocks = [block for level in (l1i, l1d) for cache_set in level.sets for block in cache_set]
+        if inclusion == 'inclusive':
+            assert all(l2.contains(block) and l3.contains(block) for block in upper_blocks)
+        elif inclusion == 'exclusive':
+            assert not any(l2.contains(block) or l3.contains(block) for block in upper_blocks)
+
+
+def test_buffer_storage():
+    # Same words read back and counters as per-block bytearrays, in less memory
+    num_sets, associativity = 16, 8
+    rng = random.Random(14)
+    accesses = [(rng.random() < 0.3, rng.randrange(0, MEMORY_SIZE, 4), rng.randrange(1 << 32))
+                for i in range(20_000)]
+
+    config = CacheConfig.from_sets(num_sets, associativity)
+    memory = init_memory(bytearray(config.memory_size))
+
+    results = {}
+    for storage in ('blocks', 'buffer'):
+        backing = bytearray(memory)
+        tracemalloc.start()
+        c = Cache(config, log=None, storage=storage, memory=backing)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        words = [c.worker_algo(address, not is_write, word) for is_write, address, word in accesses]
+        elapsed = time.perf_counter() - start
+        print(f'{storage}: {size} bytes, {elapsed:.3f}s')
+        results[storage] = (size, words, c.stats, c.memory)
+
+    (blocks_size, *blocks_results), (buffer_size, *buffer_results) = results.values()
+    assert blocks_results == buffer_results
+    assert buffer_size < blocks_size
+
+
+def test_tag_cache():
+    rng = random.Random(15)
+    accesses = [(ACCESS_WRITE if rng.random() < 0.3 else ACCESS_READ,
+                 (i * 4) % MEMORY_SIZE if rng.random() < 0.7 else rng.randrange(0, MEMORY_SIZE, 4), 1)
+                for i in range(100_000)]
+
+    for num_sets, associativity in ((16, 1), (4, 4), (2, 32)):
+        for write_back in (True, False):
+            for write_allocate in (True, False):
+                config = CacheConfig.from_sets(num_sets, associativity, write_back=write_back,
+                                               write_allocate=write_allocate)
+                c = Cache(config, log=None)
+                start = time.perf_counter()
+                expected = c.replay(accesses)
+                cache_time = time.perf_counter() - start
+
+                tag_cache = TagCache(config)
+                start = time.perf_counter()
+                stats = tag_cache.replay(accesses)
+                tag_time = time.perf_counter() - start
+
+                policy = f'{"write-back" if write_back else "write-through"}, {"" if write_allocate else "no-"}allocate'
+                print(f'{associativity}-way {policy}: Cache {cache_time:.3f}s, TagCache {tag_time:.3f}s '
+                      f'({cache_time / tag_time:.1f}x, {len(accesses) / tag_time:,.0f} accesses/sec)')
+                assert stats == expected
+
+    # 48 bit addresses, no backing memory needed
+    wide = [(ACCESS_READ, rng.randrange(1 << 48) & ~3, None) for i in range(10_000)]
+    stats = TagCache(CacheConfig(32768, CACHE_BLOCK_SIZE, 8, memory_size=1 << 48)).replay(wide + wide[-100:])
+    assert stats.hits >= 100
+
+
+def test_sweep():
+    rng = random.Random(17)
+    accesses = [(ACCESS_WRITE if rng.random() < 0.3 else ACCESS_READ,
+                 (i * 4) % MEMORY_SIZE if rng.random() < 0.7 else rng.randrange(0, MEMORY_SIZE, 4), i)
+                for i in range(20_000)]
+    configs = sweep_configs((512, 2048), (16, 64), (1, 4), (True, False))
+
+    with tempfile.TemporaryDirectory() as directory:
+        trace_path = os.path.join(directory, 'trace.txt')
+        with open(trace_path, 'w') as file:
+            for kind, address, word in accesses:
+                file.write(f'w {address} {word}\n' if kind == ACCESS_WRITE else f'r {address}\n')
+        cache_dir = os.path.join(directory, 'results')
+
+        start = time.perf_counter()
+        rows = sweep(trace_path, configs, cache_dir, max_workers=2)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        assert sweep(trace_path, configs, cache_dir) == rows
+        warm = time.perf_counter() - start
+        print(f'{len(configs)} configurations: {cold:.2f}s cold, {warm:.3f}s from the result cache')
+        assert len(os.listdir(cache_dir)) == len(configs)
+
+        for config, row in zip(configs, rows):
+            expected = Cache(config, log=None).replay(accesses).as_dict()
+            assert {name: row[name] for name in expected} == expected
+
+        # Only the new point is simulated
+        sweep(trace_path, configs + [CacheConfig(4096, 32, 2)], cache_dir)
+        assert len(os.listdir(cache_dir)) == len(configs) + 1
+
+        for name in ('table.csv', 'table.json'):
+            write_sweep_table(rows, os.path.join(directory, name))
+        with open(os.path.join(directory, 'table.csv')) as file:
+            table = list(csv.DictReader(file))
+        assert len(table) == len(rows) and list(table[0])[:len(SWEEP_COLUMNS)] == list(SWEEP_COLUMNS)
+        with open(os.path.join(directory, 'table.json')) as file:
+            assert json.load(file) == rows
+
+
+def test_write_policies():
+    # Every write policy returns the stored values and leaves the same memory
+    # after a flush, only the traffic differs
+    rng = random.Random(18)
+    accesses = []
+    for i in range(50_000):
+        # Store-heavy, mostly streaming through a few arrays
+        address = (i * 4) % 8192 + rng.choice((0, 16384, 32768)) if rng.random() < 0.8 else rng.randrange(0, MEMORY_SIZE, 4)
+        accesses.append((ACCESS_WRITE, address, i) if rng.random() < 0.5 else (ACCESS_READ, address, None))
+
+    reference = init_memory(bytearray(MEMORY_SIZE))
+    expected_reads = []
+    for kind, address, word in accesses:
+        if kind == ACCESS_WRITE:
+            WORD.pack_into(reference, address, word)
+        else:
+            expected_reads.append(WORD.unpack_from(reference, address)[0])
+
+    writes = sum(kind == ACCESS_WRITE for kind, address, word in accesses)
+    print(f'{"policy":>28} {"buffer":>6} {"hit ratio":>9} {"read bytes":>10} {"write bytes":>11} {"mem writes":>10} {"coalesced":>9}')
+    for write_back in (True, False):
+        for write_allocate in (True, False):
+            for depth in (0, 8):
+                config = CacheConfig(write_back=write_back, write_allocate=write_allocate, write_buffer_depth=depth)
+                c = Cache(config, log=None)
+                init_memory(c.memory)
+                reads = []
+                for kind, address, word in accesses:
+                    if kind == ACCESS_WRITE:
+                        c.write_word(address, word)
+                    else:
+                        reads.append(c.read_word(address))
+                assert reads == expected_reads
+                c.write_buffer.drain()
+                traffic = c.traffic
+
+                policy = f'{"write-back" if write_back else "write-through"}, {"" if write_allocate else "no-"}allocate'
+                stats = c.stats
+                print(f'{policy:>28} {depth:>6} {stats.hits / (stats.hits + stats.misses):>9.4f} {traffic.bytes_read:>10} '
+                      f'{traffic.bytes_written:>11} {traffic.memory_writes:>10} {traffic.coalesced_writes:>9}')
+                if not write_back and depth == 0:
+                    assert traffic.bytes_written == 4 * writes and traffic.memory_writes == writes
+                if depth == 0:
+                    assert traffic.coalesced_writes == 0
+                    unbuffered = traffic.as_dict()
+                else:
+                    # Coalescing never adds traffic, and saves some whenever stores go to memory
+                    assert traffic.bytes_written <= unbuffered['bytes_written']
+                    assert traffic.memory_writes + traffic.coalesced_writes == unbuffered['memory_writes']
+                    if not write_back or not write_allocate:
+                        assert traffic.memory_writes < unbuffered['memory_writes']
+
+                c.flush()
+                assert c.memory == reference
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['sweep']:
+        sweep_main(sys.argv[2:])
+    else:
+        main()
@@ -1,15 +1,46 @@
+import csv
+import math
+import mmap
+import os
+import random
+import struct
 import sys
+import tempfile
+import time
+import unittest
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 BRANCH_BASE = 16
+CHUNK_SIZE = 1 << 16
+# count_correct_np has a fixed cost per chunk, so it reads bigger ones
+VECTOR_CHUNK_SIZE = 1 << 20
+
+# Binary traces are BINARY_TRACE_MAGIC followed by chunks of
+#   count '<I', count branch addresses '<Q', count results (one byte, 0 or 1)
+BINARY_TRACE_MAGIC = b"BTRC"
+CHUNK_HEADER = struct.Struct("<I")
+# Bytes read at a time by sharded_bp's workers
+SHARD_READ_SIZE = 1 << 20
+
+
+def bht_size(predictor_size_bits, memory_size_bits) -> int:
+    # Entries in a BHT of memory_size_bits bits
+    return (
+        memory_size_bits
+        if predictor_size_bits == 0
+        else int(memory_size_bits / predictor_size_bits)
+    )
 
 
 class BHT:
     def __init__(self, predictor_size_bits, memory_size_bits):
-        self.size = (
-            memory_size_bits
-            if predictor_size_bits == 0
-            else int(memory_size_bits / predictor_size_bits)
-        )
+        self.size = bht_size(predictor_size_bits, memory_size_bits)
         self.arr = [0] * self.size
 
     def addr_to_int(self, branch_addr):
@@ -35,6 +66,426 @@ def read_trace(fileName: str) -> list:
     return branches
 
 
+def read_text_trace_chunks(fileName: str, chunk_size: int = CHUNK_SIZE):
+    # Yields (addresses array('Q'), results array('B')) of up to chunk_size
+    # branches, parsing each line once, so memory stays flat for any trace
+    addresses, results = array("Q"), array("B")
+    with open(fileName) as file:
+        for line in file:
+            split = line.split()
+            if not split or split[0] == "#eof":
+                continue
+            addresses.append(int(split[0], BRANCH_BASE))
+            results.append(int(split[1]))
+            if len(addresses) == chunk_size:
+                yield addresses, results
+                addresses, results = array("Q"), array("B")
+
+    if addresses:
+        yield addresses, results
+
+
+def read_binary_trace_chunks(fileName: str):
+    # Chunks come straight out of a read-only mapping of the file
+    with open(fileName, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped:
+        if mapped[: len(BINARY_TRACE_MAGIC)] != BINARY_TRACE_MAGIC:
+            raise ValueError(f"{fileName} is not a binary branch trace")
+
+        view = memoryview(mapped)
+        try:
+            pos = len(BINARY_TRACE_MAGIC)
+            while pos < len(mapped):
+                (count,) = CHUNK_HEADER.unpack_from(view, pos)
+                pos += CHUNK_HEADER.size
+                addresses, results = array("Q"), array("B")
+                addresses.frombytes(view[pos : pos + count * 8])
+                pos += count * 8
+                results.frombytes(view[pos : pos + count])
+                pos += count
+                if sys.byteorder == "big":
+                    addresses.byteswap()
+                yield addresses, results
+        finally:
+            view.release()
+
+
+def read_trace_chunks(fileName: str, chunk_size: int = CHUNK_SIZE):
+    with open(fileName, "rb") as file:
+        binary = file.read(len(BINARY_TRACE_MAGIC)) == BINARY_TRACE_MAGIC
+    if binary:
+        return read_binary_trace_chunks(fileName)
+    return read_text_trace_chunks(fileName, chunk_size)
+
+
+def write_binary_trace(fileName: str, chunks) -> int:
+    # Returns the number of branches written
+    total = 0
+    with open(fileName, "wb") as file:
+        file.write(BINARY_TRACE_MAGIC)
+        for addresses, results in chunks:
+            addresses = array("Q", addresses)
+            if sys.byteorder == "big":
+                addresses.byteswap()
+            file.write(CHUNK_HEADER.pack(len(addresses)))
+            file.write(addresses.tobytes())
+            file.write(bytes(results))
+            total += len(addresses)
+
+    return total
+
+
+def count_correct(addresses, results, predictor_size: int, bht: BHT) -> int:
+    # Runs one chunk through bht as static_bp (predictor_size 0), one_bit_bp,
+    # two_bit_bp or three_bit_bp would: an n bit saturating counter predicts
+    # taken from half its range up, and a one bit counter is the last outcome
+    if predictor_size == 0:
+        return results.count(0)
+
+    max_saturated = (1 << predictor_size) - 1
+    taken_from = (max_saturated + 1) / 2
+    arr, size = bht.arr, bht.size
+    branches_correct = 0
+
+    for addr, result in zip(addresses, results):
+        index = addr % size
+        counter = arr[index]
+        if result:
+            if counter >= taken_from:
+                branches_correct += 1
+            if counter < max_saturated:
+                arr[index] = counter + 1
+        else:
+            if counter < taken_from:
+                branches_correct += 1
+            if counter > 0:
+                arr[index] = counter - 1
+
+    return branches_correct
+
+
+def count_correct_np(addresses, results, predictor_size: int, bht: BHT) -> int:
+    # Vectorized count_correct, bit-identical results. Branches are grouped by
+    # BHT index with a stable argsort, so each counter sees its own updates in
+    # trace order. The groups then form one sequence of counter updates,
+    # where each group start resets the counter to its BHT value. The
+    # sequence is cut into rows of equal width, which run side by side:
+    #   1. each row's net effect on the counter is a clamp
+    #      s -> min(max(s + step, lo), hi), composed one column at a time
+    #   2. chaining those clamps gives the counter entering every row
+    #   3. the rows replay from those values, column by column
+    # so Python loops over columns and rows, never over single branches.
+    # bht.arr becomes a uint8 ndarray.
+    if np is None:
+        raise ImportError("count_correct_np requires numpy")
+
+    results = np.frombuffer(results, dtype=np.uint8)
+    if predictor_size == 0:
+        return int(np.count_nonzero(results == 0))
+
+    if not isinstance(bht.arr, np.ndarray):
+        bht.arr = np.array(bht.arr, dtype=np.uint8)
+    count = len(results)
+    if count == 0:
+        return 0
+
+    max_saturated = (1 << predictor_size) - 1
+    index = np.frombuffer(addresses, dtype=np.uint64) % np.uint64(bht.size)
+    # Stable sorts of 16 bit keys are radix sorts
+    index = index.astype(np.uint16 if bht.size <= 1 << 16 else np.uint64)
+    order = np.argsort(index, kind="stable")
+    index = index[order]
+    taken = results[order].astype(bool)
+
+    starts = np.empty(count, dtype=bool)
+    starts[0] = True
+    np.not_equal(index[1:], index[:-1], out=starts[1:])
+
+    # Every branch is a clamp s -> min(max(s + step, lo), hi) on its counter.
+    # A group start reads the BHT value instead, making it a constant. The
+    # padding at the end is the identity. Rows are stored column major so
+    # each column is contiguous.
+    width = max(1, math.isqrt(count))
+    rows = -(-count // width)
+    first = np.flatnonzero(starts)
+    initial = bht.arr[index[first]].astype(np.int8)
+    step = np.zeros(rows * width, dtype=np.int8)
+    step[:count] = np.where(taken, 1, -1)
+    constant = np.minimum(np.maximum(initial + step[first], 0), max_saturated)
+    lo = np.zeros(rows * width, dtype=np.int8)
+    hi = np.full(rows * width, max_saturated, dtype=np.int8)
+    lo[first] = hi[first] = constant
+    step[first] = 0
+    step, lo, hi = (a.reshape(rows, width).T.copy() for a in (step, lo, hi))
+
+    # 1. Net clamp of every row, composed one column at a time
+    row_step = np.zeros(rows, dtype=np.int16)
+    row_lo = np.zeros(rows, dtype=np.int16)
+    row_hi = np.full(rows, max_saturated, dtype=np.int16)
+    scratch = np.empty(rows, dtype=np.int16)
+    for x, x_lo, x_hi in zip(step, lo, hi):
+        np.add(row_hi, x, out=scratch)
+        np.maximum(scratch, x_lo, out=scratch)
+        np.minimum(scratch, x_hi, out=row_hi)
+        np.add(row_lo, x, out=scratch)
+        np.maximum(scratch, x_lo, out=row_lo)
+        row_step += x
+
+    # 2. Counter entering every row, the first row starts with a reset
+    entering = [0] * rows
+    counter = 0
+    for row, (row_step_, row_lo_, row_hi_) in enumerate(
+        zip(row_step.tolist(), row_lo.tolist(), row_hi.tolist())
+    ):
+        entering[row] = counter
+        counter = min(max(counter + row_step_, row_lo_), row_hi_)
+
+    # 3. Counter before every branch, group starts read the BHT value
+    before = np.empty((width, rows), dtype=np.int16)
+    counter = np.array(entering, dtype=np.int16)
+    for column, (x, x_lo, x_hi) in enumerate(zip(step, lo, hi)):
+        before[column] = counter
+        counter += x
+        np.maximum(counter, x_lo, out=counter)
+        np.minimum(counter, x_hi, out=counter)
+
+    # Sorted position p is column p % width of row p // width
+    def column_major(positions):
+        return positions % width * rows + positions // width
+
+    before = before.ravel()
+    before[column_major(first)] = initial
+
+    # Padding compares against -1, which no prediction matches
+    outcome = np.full(rows * width, -1, dtype=np.int8)
+    outcome[:count] = taken
+    outcome = outcome.reshape(rows, width).T.ravel()
+    correct = np.count_nonzero((before >= (max_saturated + 1) / 2) == outcome)
+
+    ends = np.flatnonzero(np.append(starts[1:], True))
+    last = before[column_major(ends)] + np.where(taken[ends], 1, -1)
+    bht.arr[index[ends]] = np.minimum(np.maximum(last, 0), max_saturated)
+
+    return int(correct)
+
+
+def chunked_bp(chunks, predictor_size: int, bht: BHT, counter=count_correct) -> dict:
+    # Streaming equivalent of the list based predictors, counter is
+    # count_correct or count_correct_np
+    branches_checked, branches_correct = 0, 0
+
+    for addresses, results in chunks:
+        branches_checked += len(addresses)
+        branches_correct += counter(addresses, results, predictor_size, bht)
+
+    return {
+        "checked": branches_checked,
+        "correct": branches_correct,
+        "percentage": round(branches_correct / branches_checked * 100.0, 2),
+    }
+
+
+def sweep_bp(chunks, predictor_sizes: list, memory_sizes: list, counter=count_correct) -> list:
+    # Evaluates every (predictor size, BHT size) pair in one pass over the
+    # trace, each chunk is read and parsed once and fed to every BHT.
+    # Returns one row per pair, predictor size major.
+    bhts = {
+        (predictor_size, memory_size): BHT(predictor_size, memory_size)
+        for predictor_size in predictor_sizes
+        for memory_size in memory_sizes
+    }
+    correct = dict.fromkeys(bhts, 0)
+    branches_checked = 0
+
+    for addresses, results in chunks:
+        branches_checked += len(addresses)
+        for (predictor_size, memory_size), bht in bhts.items():
+            correct[predictor_size, memory_size] += counter(
+                addresses, results, predictor_size, bht
+            )
+
+    return [
+        {
+            "predictor_size": predictor_size,
+            "memory_size": memory_size,
+            "checked": branches_checked,
+            "correct": branches_correct,
+            "percentage": round(branches_correct / branches_checked * 100.0, 2),
+        }
+        for (predictor_size, memory_size), branches_correct in correct.items()
+    ]
+
+
+def write_results_table(rows: list, fileName: str) -> None:
+    with open(fileName, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# Sharded traces
+#
+# A text trace is split into byte ranges on line boundaries and each range is
+# simulated in its own process. The branches just before a range (its warm-up
+# window) are simulated but not counted, so the counters start close to the
+# state a serial run would have. Counter values before the warm-up are
+# unknown, so each counter also tracks the interval of values it could hold
+# in the serial run: a branch whose prediction differs across that interval
+# may be counted differently than in the serial run, and the number of such
+# branches bounds the error.
+
+
+def shard_bounds(fileName: str, shards: int) -> list:
+    # (start, end) byte ranges, each starting at a line start
+    size = os.path.getsize(fileName)
+    starts = [0]
+    with open(fileName, "rb") as file:
+        for shard in range(1, shards):
+            file.seek(max(size * shard // shards - 1, 0))
+            file.readline()
+            starts.append(max(file.tell(), starts[-1]))
+    ends = starts[1:] + [size]
+    return [(start, end) for start, end in zip(starts, ends) if start < end]
+
+
+def warmup_start(fileName: str, start: int, warmup: int) -> int:
+    # Offset of the line warmup lines before start (or 0), found by reading
+    # backwards a block at a time
+    BLOCK_SIZE = 1 << 16
+    position, lines = start, 0
+    if warmup == 0:
+        return start
+
+    with open(fileName, "rb") as file:
+        while position > 0:
+            block_start = max(position - BLOCK_SIZE, 0)
+            file.seek(block_start)
+            block = file.read(position - block_start)
+            # The newline ending the line before start is not a line boundary to count
+            end = len(block) - 1 if position == start else len(block)
+            newline = block.rfind(b"\n", 0, end)
+            while newline >= 0:
+                lines += 1
+                if lines == warmup:
+                    return block_start + newline + 1
+                newline = block.rfind(b"\n", 0, newline)
+            position = block_start
+
+    return 0
+
+
+def shard_lines(file, start: int, end: int):
+    # Yields lists of the lines in [start, end), both line starts
+    file.seek(start)
+    remaining = end - start
+    carry = b""
+    while remaining > 0:
+        data = file.read(min(SHARD_READ_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        lines = (carry + data).split(b"\n")
+        carry = lines.pop()
+        yield lines
+    if carry:
+        yield [carry]
+
+
+def simulate_shard(fileName: str, start: int, end: int, warmup: int,
+                   predictor_size: int, memory_size: int) -> dict:
+    # Runs in a worker process, counts the branches in [start, end) after
+    # simulating the warm-up lines before start. A static predictor is a
+    # counter stuck at 0.
+    max_saturated = (1 << predictor_size) - 1
+    taken_from = (max_saturated + 1) / 2
+    size = bht_size(predictor_size, memory_size)
+    counters = bytearray(size)
+    # Counters whose serial run value is known (all of them from the trace
+    # start) are settled and equal counters[index]; ranges holds the (low,
+    # high) bounds of the others that were seen, unseen ones may be anything
+    first = warmup_start(fileName, start, warmup) if start else 0
+    settled = bytearray([first == 0]) * size
+    ranges = {}
+
+    checked = correct = uncertain = warmed = 0
+    with open(fileName, "rb") as file:
+        for region_start, region_end, counted in ((first, start, False), (start, end, True)):
+            for lines in shard_lines(file, region_start, region_end):
+                for line in lines:
+                    split = line.split()
+                    # Blank lines and "#eof"
+                    if len(split) != 2:
+                        continue
+                    taken = split[1] == b"1"
+                    index = int(split[0], BRANCH_BASE) % size
+                    counter = counters[index]
+                    if counted:
+                        checked += 1
+                        if (counter >= taken_from) == taken:
+                            correct += 1
+                    else:
+                        warmed += 1
+                    if taken:
+                        if counter < max_saturated:
+                            counters[index] = counter + 1
+                    elif counter > 0:
+                        counters[index] = counter - 1
+                    if settled[index]:
+                        continue
+
+                    low, high = ranges.get(index, (0, max_saturated))
+                    if counted and (low >= taken_from) != (high >= taken_from):
+                        uncertain += 1
+                    if taken:
+                        low = low + 1 if low < max_saturated else low
+                        high = high + 1 if high < max_saturated else high
+                    else:
+                        low = low - 1 if low > 0 else low
+                        high = high - 1 if high > 0 else high
+                    if low == high:
+                        settled[index] = 1
+                        ranges.pop(index, None)
+                    else:
+                        ranges[index] = (low, high)
+
+    return {"checked": checked, "correct": correct, "uncertain": uncertain, "warmup": warmed}
+
+
+def sharded_bp(fileName: str, predictor_size: int, memory_size: int, shards: int = None,
+               warmup: int = 100_000, max_workers: int = None) -> dict:
+    # Same counts as chunked_bp up to error_bound: the serial run's correct
+    # count lies within correct +- error_bound
+    if shards is None:
+        shards = os.cpu_count() or 1
+
+    bounds = shard_bounds(fileName, shards)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(
+                simulate_shard,
+                *zip(*[(fileName, start, end, warmup, predictor_size, memory_size)
+                       for start, end in bounds]),
+            )
+        )
+
+    branches_checked = sum(result["checked"] for result in results)
+    branches_correct = sum(result["correct"] for result in results)
+    error_bound = sum(result["uncertain"] for result in results)
+    return {
+        "checked": branches_checked,
+        "correct": branches_correct,
+        "percentage": round(branches_correct / branches_checked * 100.0, 2),
+        "error_bound": error_bound,
+        "percentage_range": (
+            round(max(branches_correct - error_bound, 0) / branches_checked * 100.0, 2),
+            round(min(branches_correct + error_bound, branches_checked) / branches_checked * 100.0, 2),
+        ),
+        "shards": len(bounds),
+        "warmup_branches": sum(result["warmup"] for result in results),
+    }
+
+
 def static_bp(branches: list) -> dict:
     branches_checked, branches_correct, prediction = 0, 0, 0
 
@@ -117,9 +568,513 @@ def three_bit_bp(branches: list, bht: BHT) -> dict:
     }
 
 
+# Correlating predictors
+#
+# Each predictor has predict(addr) -> bool, then update(addr, taken) for the
+# same branch, and storage_bits() for its total state. Counter tables are
+# PackedBHTs, so a predictor built from BHT(bits, memory_size) tables costs
+# the same memory_size bits as one_bit_bp/two_bit_bp given that size.
+
+
+class PackedBHT(BHT):
+    # BHT of n bit saturating counters, one byte each in a bytearray, indexed
+    # by an already hashed int and counting like saturating_counter
+    def __init__(self, predictor_size_bits, memory_size_bits):
+        if not 1 <= predictor_size_bits <= 8:
+            raise ValueError(f"PackedBHT counters are 1 to 8 bits, not {predictor_size_bits}")
+        self.size = bht_size(predictor_size_bits, memory_size_bits)
+        self.arr = bytearray(self.size)
+        self.max_saturated = (1 << predictor_size_bits) - 1
+        self.taken_from = (self.max_saturated + 1) / 2
+        self.storage_bits = self.size * predictor_size_bits
+
+    def predict(self, index: int) -> bool:
+        return self.arr[index % self.size] >= self.taken_from
+
+    def update(self, index: int, taken: bool):
+        index %= self.size
+        counter = self.arr[index]
+        if taken:
+            if counter < self.max_saturated:
+                self.arr[index] = counter + 1
+        elif counter > 0:
+            self.arr[index] = counter - 1
+
+
+class BimodalPredictor:
+    # Same predictions as one_bit_bp/two_bit_bp/three_bit_bp
+    def __init__(self, predictor_size, memory_size):
+        self.table = PackedBHT(predictor_size, memory_size)
+
+    def predict(self, addr: int) -> bool:
+        return self.table.predict(addr)
+
+    def update(self, addr: int, taken: bool):
+        self.table.update(addr, taken)
+
+    def storage_bits(self) -> int:
+        return self.table.storage_bits
+
+
+class GsharePredictor:
+    # Counters indexed by the branch address xor the global history
+    def __init__(self, predictor_size, memory_size, history_bits):
+        self.table = PackedBHT(predictor_size, memory_size)
+        self.history_bits = history_bits
+        self.history_mask = (1 << history_bits) - 1
+        self.history = 0
+
+    def index(self, addr: int) -> int:
+        return addr ^ self.history
+
+    def predict(self, addr: int) -> bool:
+        return self.table.predict(self.index(addr))
+
+    def update(self, addr: int, taken: bool):
+        self.table.update(self.index(addr), taken)
+        self.history = ((self.history << 1) | taken) & self.history_mask
+
+    def storage_bits(self) -> int:
+        return self.table.storage_bits + self.history_bits
+
+
+class GAgPredictor(GsharePredictor):
+    # Two-level adaptive, global history only
+    def index(self, addr: int) -> int:
+        return self.history
+
+
+class PAgPredictor:
+    # Two-level adaptive: per-address history registers, one shared pattern table
+    def __init__(self, predictor_size, memory_size, history_bits, history_entries):
+        self.table = PackedBHT(predictor_size, memory_size)
+        self.history_bits = history_bits
+        self.history_mask = (1 << history_bits) - 1
+        self.histories = array("I", [0]) * history_entries
+
+    def predict(self, addr: int) -> bool:
+        return self.table.predict(self.histories[addr % len(self.histories)])
+
+    def update(self, addr: int, taken: bool):
+        entry = addr % len(self.histories)
+        history = self.histories[entry]
+        self.table.update(history, taken)
+        self.histories[entry] = ((history << 1) | taken) & self.history_mask
+
+    def storage_bits(self) -> int:
+        return self.table.storage_bits + len(self.histories) * self.history_bits
+
+
+class TournamentPredictor:
+    # A 2 bit chooser per address picks first (low) or second (high), and
+    # only learns from branches where the two disagree
+    def __init__(self, first, second, chooser_memory_size):
+        self.first = first
+        self.second = second
+        self.chooser = PackedBHT(2, chooser_memory_size)
+        self.first_prediction = self.second_prediction = False
+
+    def predict(self, addr: int) -> bool:
+        self.first_prediction = self.first.predict(addr)
+        self.second_prediction = self.second.predict(addr)
+        if self.chooser.predict(addr):
+            return self.second_prediction
+        return self.first_prediction
+
+    def update(self, addr: int, taken: bool):
+        if self.first_prediction != self.second_prediction:
+            self.chooser.update(addr, self.second_prediction == taken)
+        self.first.update(addr, taken)
+        self.second.update(addr, taken)
+
+    def storage_bits(self) -> int:
+        return self.first.storage_bits() + self.second.storage_bits() + self.chooser.storage_bits
+
+
+# Hash multiplier (2^32 / golden ratio) spreading history segments over an index
+HASH_MULTIPLIER = 0x9E3779B1
+# TAGE useful counters are halved every 2^18 branches
+USEFUL_RESET_MASK = (1 << 18) - 1
+HALVE = bytes(value >> 1 for value in range(256))
+
+
+class TagePredictor:
+    # TAGE: a bimodal base table plus num_tables tagged tables indexed by the
+    # branch address hashed with geometrically longer global histories. The
+    # longest matching table provides the prediction, the next one (or the
+    # base) is the alternate. Entries are a 3 bit counter (taken from 4), a
+    # tag and a 2 bit useful counter in flat arrays of num_tables << table_bits
+    # entries, and each table keeps folded history registers (index, tag and
+    # second tag hash) updated with shifts and xors, so predict/update
+    # allocate nothing beyond ints.
+    def __init__(self, base_memory_size, num_tables=4, table_bits=10, tag_bits=8,
+                 min_history=4, max_history=64):
+        # The second tag hash is tag_bits - 1 wide and folds need a width,
+        # slot_tags holds 16 bit tags
+        if table_bits < 1:
+            raise ValueError(f"TAGE needs table_bits >= 1, not {table_bits}")
+        if not 2 <= tag_bits <= 16:
+            raise ValueError(f"TAGE tags are 2 to 16 bits, not {tag_bits}")
+        self.base = PackedBHT(2, base_memory_size)
+        self.num_tables = num_tables
+        self.table_bits = table_bits
+        self.index_mask = (1 << table_bits) - 1
+        self.tag_bits = tag_bits
+        self.tag_mask = (1 << tag_bits) - 1
+        if num_tables == 1:
+            self.lengths = [min_history]
+        else:
+            ratio = (max_history / min_history) ** (1 / (num_tables - 1))
+            self.lengths = [round(min_history * ratio ** table) for table in range(num_tables)]
+        self.history = 0
+        self.history_mask = (1 << (max(self.lengths) + 1)) - 1
+
+        entries = num_tables << table_bits
+        self.counters = bytearray(entries)
+        # Entries start with a tag no branch computes, so they never match
+        # before being allocated
+        self.tags = array("I", [1 << tag_bits]) * entries
+        self.useful = bytearray(entries)
+        # Folded registers, three per table, and for each one the
+        # (register, history length, width, mask, where the outgoing bit lands)
+        self.folded = array("I", [0]) * (3 * num_tables)
+        self.fold_plan = tuple(
+            (3 * table + offset, length, width, (1 << width) - 1, length % width)
+            for table, length in enumerate(self.lengths)
+            for offset, width in enumerate((table_bits, tag_bits, tag_bits - 1))
+        )
+        # Set by predict for update: slot and tag per table, provider and predictions
+        self.slots = array("I", [0]) * num_tables
+        self.slot_tags = array("H", [0]) * num_tables
+        self.provider = -1
+        self.provider_prediction = self.alt_prediction = self.prediction = self.weak = False
+        # 4 bit counter, trust the alternate over a new provider from 8 up
+        self.use_alt = 8
+        self.branches = 0
+
+    def predict(self, addr: int) -> bool:
+        folded, slots, slot_tags, tags = self.folded, self.slots, self.slot_tags, self.tags
+        table_bits, index_mask, tag_mask = self.table_bits, self.index_mask, self.tag_mask
+        hashed = addr ^ (addr >> table_bits)
+        provider = alt = -1
+
+        for table in range(self.num_tables - 1, -1, -1):
+            slot = ((hashed ^ folded[3 * table]) & index_mask) | (table << table_bits)
+            tag = (addr ^ folded[3 * table + 1] ^ (folded[3 * table + 2] << 1)) & tag_mask
+            slots[table] = slot
+            slot_tags[table] = tag
+            if tags[slot] == tag:
+                if provider < 0:
+                    provider = table
+                elif alt < 0:
+                    alt = table
+
+        if alt >= 0:
+            alt_prediction = self.counters[slots[alt]] >= 4
+        else:
+            alt_prediction = self.base.predict(addr)
+
+        prediction = alt_prediction
+        self.weak = False
+        if provider >= 0:
+            slot = slots[provider]
+            counter = self.counters[slot]
+            self.provider_prediction = counter >= 4
+            self.weak = (counter == 3 or counter == 4) and self.useful[slot] == 0
+            if not (self.weak and self.use_alt >= 8):
+                prediction = self.provider_prediction
+
+        self.provider = provider
+        self.alt_prediction = alt_prediction
+        self.prediction = prediction
+        return prediction
+
+    def update(self, addr: int, taken: bool):
+        provider, slots, counters, useful = self.provider, self.slots, self.counters, self.useful
+
+        if provider >= 0:
+            slot = slots[provider]
+            if self.provider_prediction != self.alt_prediction:
+                if self.weak:
+                    if self.alt_prediction == taken:
+                        self.use_alt = min(self.use_alt + 1, 15)
+                    else:
+                        self.use_alt = max(self.use_alt - 1, 0)
+                if self.provider_prediction == taken:
+                    useful[slot] = min(useful[slot] + 1, 3)
+                else:
+                    useful[slot] = max(useful[slot] - 1, 0)
+            counter = counters[slot]
+            if taken:
+                if counter < 7:
+                    counters[slot] = counter + 1
+            elif counter > 0:
+                counters[slot] = counter - 1
+        else:
+            self.base.update(addr, taken)
+
+        # Mispredicted: take over an entry nobody finds useful in a longer table
+        if self.prediction != taken and provider < self.num_tables - 1:
+            for table in range(provider + 1, self.num_tables):
+                slot = slots[table]
+                if useful[slot] == 0:
+                    self.tags[slot] = self.slot_tags[table]
+                    counters[slot] = 4 if taken else 3
+                    break
+            else:
+                for table in range(provider + 1, self.num_tables):
+                    useful[slots[table]] -= 1
+
+        self.branches += 1
+        if self.branches & USEFUL_RESET_MASK == 0:
+            useful[:] = useful.translate(HALVE)
+
+        history = ((self.history << 1) | taken) & self.history_mask
+        self.history = history
+        folded = self.folded
+        for register, length, width, mask, outpoint in self.fold_plan:
+            value = ((folded[register] << 1) | taken) ^ (((history >> length) & 1) << outpoint)
+            folded[register] = (value ^ (value >> width)) & mask
+
+    def storage_bits(self) -> int:
+        entry_bits = 3 + self.tag_bits + 2
+        return (self.base.storage_bits + (self.num_tables << self.table_bits) * entry_bits
+                + max(self.lengths) + 4)
+
+
+class PerceptronPredictor:
+    # Hashed perceptron: feature 0 is the branch address alone, the others
+    # hash it with one segment of the global history each. Every feature has
+    # its own table of 8 bit weights in one flat array('b'); the prediction is
+    # the sign of their sum, and weights train on a misprediction or when the
+    # sum is within theta of zero.
+    def __init__(self, num_features=8, table_bits=8, history_length=32):
+        self.num_features = num_features
+        self.table_bits = table_bits
+        self.index_mask = (1 << table_bits) - 1
+        self.history_length = history_length
+        self.history = 0
+        self.history_mask = (1 << history_length) - 1
+
+        segment = max(1, history_length // max(1, num_features - 1))
+        self.starts = array("I", [0] + [segment * feature for feature in range(num_features - 1)])
+        self.masks = array("Q", [0] + [(1 << segment) - 1] * (num_features - 1))
+        self.weights = array("b", [0]) * (num_features << table_bits)
+        self.slots = array("I", [0]) * num_features
+        self.theta = int(1.93 * num_features + 14)
+        self.total = 0
+
+    def predict(self, addr: int) -> bool:
+        history, weights, slots = self.history, self.weights, self.slots
+        table_bits, index_mask = self.table_bits, self.index_mask
+        hashed = addr ^ (addr >> table_bits)
+        total = 0
+
+        for feature in range(self.num_features):
+            segment = (history >> self.starts[feature]) & self.masks[feature]
+            slot = ((hashed ^ ((segment * HASH_MULTIPLIER) >> 16)) & index_mask) | (feature << table_bits)
+            slots[feature] = slot
+            total += weights[slot]
+
+        self.total = total
+        return total >= 0
+
+    def update(self, addr: int, taken: bool):
+        total, weights = self.total, self.weights
+        if (total >= 0) != taken or -self.theta <= total <= self.theta:
+            if taken:
+                for slot in self.slots:
+                    if weights[slot] < 127:
+                        weights[slot] += 1
+            else:
+                for slot in self.slots:
+                    if weights[slot] > -128:
+                        weights[slot] -= 1
+
+        self.history = ((self.history << 1) | taken) & self.history_mask
+
+    def storage_bits(self) -> int:
+        return len(self.weights) * 8 + self.history_length
+
+
+def standard_predictors(memory_size: int) -> dict:
+    # Predictors of about memory_size bits each, for comparison at equal cost
+    counters = memory_size // 2
+    history_bits = max(1, counters.bit_length() - 1)
+    local_bits = max(1, (counters // 2).bit_length() - 1)
+    # TAGE gets 4 tagged tables in about 3/4 of the budget (13 bits an entry,
+    # 64 history bits and the use-alt counter) and the rest as its base table
+    tage_table_bits = max(1, (memory_size * 3 // 4 // (4 * 13)).bit_length() - 1)
+    tage_base_size = max(2, memory_size - (4 << tage_table_bits) * 13 - 64 - 4)
+    return {
+        "one bit": BimodalPredictor(1, memory_size),
+        "two bit": BimodalPredictor(2, memory_size),
+        "gshare": GsharePredictor(2, memory_size, history_bits),
+        "GAg": GAgPredictor(2, memory_size, history_bits),
+        "PAg": PAgPredictor(2, memory_size // 2, local_bits, max(1, memory_size // 2 // local_bits)),
+        "tournament": TournamentPredictor(
+            BimodalPredictor(2, memory_size // 4),
+            GsharePredictor(2, memory_size // 2, max(1, (counters // 2).bit_length() - 1)),
+            memory_size // 4,
+        ),
+        "TAGE": TagePredictor(tage_base_size, 4, tage_table_bits),
+        "perceptron": PerceptronPredictor(8, max(1, (memory_size // 64).bit_length() - 1)),
+    }
+
+
+def compare_bp(chunks, predictors: dict) -> list:
+    # Runs every predictor over the trace in one pass, one row per predictor
+    correct = dict.fromkeys(predictors, 0)
+    branches_checked = 0
+
+    for addresses, results in chunks:
+        branches_checked += len(addresses)
+        for name, predictor in predictors.items():
+            predict, update = predictor.predict, predictor.update
+            branches_correct = 0
+            for addr, result in zip(addresses, results):
+                if predict(addr) == result:
+                    branches_correct += 1
+                update(addr, result)
+            correct[name] += branches_correct
+
+    return [
+        {
+            "predictor": name,
+            "storage_bits": predictor.storage_bits(),
+            "checked": branches_checked,
+            "correct": correct[name],
+            "percentage": round(correct[name] / branches_checked * 100.0, 2),
+        }
+        for name, predictor in predictors.items()
+    ]
+
+
+def sweep_main(cmd_args: list):
+    # branch_prediction.py sweep <trace> <predictor sizes> <BHT sizes> [out.csv]
+    # with comma separated sizes, e.g. sweep trace.txt 0,1,2,3 16,64,256,1024
+    if len(cmd_args) not in (5, 6):
+        print(
+            """Please call sweep with args for trace file name, comma separated
+            numbers of bits for predictor and sizes of BHT, and optionally a CSV file"""
+        )
+        return
+
+    predictor_sizes = [int(size) for size in cmd_args[3].split(",")]
+    memory_sizes = [int(size) for size in cmd_args[4].split(",")]
+    counter = count_correct if np is None else count_correct_np
+    rows = sweep_bp(
+        read_trace_chunks(cmd_args[2], VECTOR_CHUNK_SIZE), predictor_sizes, memory_sizes, counter
+    )
+
+    print(f"{'bits':>4} {'memory size':>11} {'checked':>10} {'correct':>10} {'percentage':>10}")
+    for row in rows:
+        print(
+            f"{row['predictor_size']:>4} {row['memory_size']:>11} {row['checked']:>10} "
+            f"{row['correct']:>10} {row['percentage']:>10.2f}"
+        )
+    if len(cmd_args) == 6:
+        write_results_table(rows, cmd_args[5])
+
+
+def compare_main(cmd_args: list):
+    # branch_prediction.py compare <trace> <memory size> [out.csv]
+    if len(cmd_args) not in (4, 5):
+        print(
+            """Please call compare with args for trace file name, size of BHT
+            in bits, and optionally a CSV file"""
+        )
+        return
+
+    rows = compare_bp(read_trace_chunks(cmd_args[2]), standard_predictors(int(cmd_args[3])))
+
+    print(f"{'predictor':>10} {'storage bits':>12} {'checked':>10} {'correct':>10} {'percentage':>10}")
+    for row in rows:
+        print(
+            f"{row['predictor']:>10} {row['storage_bits']:>12} {row['checked']:>10} "
+            f"{row['correct']:>10} {row['percentage']:>10.2f}"
+        )
+    if len(cmd_args) == 5:
+        write_results_table(rows, cmd_args[4])
+
+
+def shard_main(cmd_args: list):
+    # branch_prediction.py shard <trace> <bits> <memory size> [shards] [warm-up branches]
+    if len(cmd_args) not in (5, 6, 7):
+        print(
+            """Please call shard with args for trace file name, number of bits
+            for predictor, size of BHT, and optionally the number of shards and
+            the warm-up branches per shard"""
+        )
+        return
+
+    shards = int(cmd_args[5]) if len(cmd_args) > 5 else None
+    warmup = int(cmd_args[6]) if len(cmd_args) > 6 else 100_000
+    start = time.perf_counter()
+    result = sharded_bp(cmd_args[2], int(cmd_args[3]), int(cmd_args[4]), shards, warmup)
+    print(result)
+    print(f"{time.perf_counter() - start:.2f}s")
+
+
+def benchmark_main(cmd_args: list):
+    # branch_prediction.py benchmark [branches]: times count_correct against
+    # count_correct_np on a synthetic trace of loop-like branches
+    if np is None:
+        print("benchmark requires numpy")
+        return
+
+    count = int(cmd_args[2]) if len(cmd_args) > 2 else 10_000_000
+    rng = np.random.default_rng(22)
+    branch_pcs = rng.integers(0x400000, 0x500000, size=4096, dtype=np.uint64)
+    bias = rng.random(4096)
+    which = rng.zipf(1.3, size=count) % 4096
+    addresses = array("Q", branch_pcs[which].tobytes())
+    results = array("B", (rng.random(count) < bias[which]).astype(np.uint8).tobytes())
+
+    for predictor_size in (2, 3):
+        for memory_size in (256, 4096):
+            timings = []
+            for counter in (count_correct, count_correct_np):
+                bht = BHT(predictor_size, memory_size)
+                start = time.perf_counter()
+                correct = 0
+                for offset in range(0, count, VECTOR_CHUNK_SIZE):
+                    correct += counter(
+                        addresses[offset : offset + VECTOR_CHUNK_SIZE],
+                        results[offset : offset + VECTOR_CHUNK_SIZE],
+                        predictor_size,
+                        bht,
+                    )
+                timings.append((time.perf_counter() - start, correct))
+
+            (scalar_time, scalar_correct), (vector_time, vector_correct) = timings
+            assert scalar_correct == vector_correct
+            print(
+                f"{predictor_size} bit, memory size {memory_size}: {count} branches, "
+                f"{scalar_time:.2f}s scalar, {vector_time:.2f}s numpy "
+                f"({scalar_time / vector_time:.1f}x), {correct / count * 100.0:.2f}%"
+            )
+
+
 def main():
     cmd_args = sys.argv
 
+    if len(cmd_args) > 1 and cmd_args[1] == "benchmark":
+        benchmark_main(cmd_args)
+        return
+
+    if len(cmd_args) > 1 and cmd_args[1] == "sweep":
+        sweep_main(cmd_args)
+        return
+
+    if len(cmd_args) > 1 and cmd_args[1] == "compare":
+        compare_main(cmd_args)
+        return
+
+    if len(cmd_args) > 1 and cmd_args[1] == "shard":
+        shard_main(cmd_args)
+        return
+
     if len(cmd_args) != 4:
         print(
             """Please call with args for trace file name, 
@@ -130,32 +1085,264 @@ def main():
     trace = cmd_args[1]
     predictor_size = int(cmd_args[2])
     memory_size = int(cmd_args[3])
-    branches = read_trace(trace)
-
-    bht = BHT(predictor_size, memory_size)
 
     if predictor_size == 0:
         print("=== STATIC ===")
-        static = static_bp(branches)
-        print(static)
 
     elif predictor_size == 1:
         print(f"=== ONE BIT === | === MEMORY SIZE {memory_size} ===")
-        one_bit = one_bit_bp(branches, bht)
-        print(one_bit)
 
     elif predictor_size == 2:
         print(f"=== TWO BIT === | === MEMORY SIZE {memory_size} ===")
-        two_bit = two_bit_bp(branches, bht)
-        print(two_bit)
 
     elif predictor_size == 3:
         print(f"=== THREE BIT === | === MEMORY SIZE {memory_size} ===")
-        three_bit = three_bit_bp(branches, bht)
-        print(three_bit)
 
     else:
         print("please enter valid predictor size in size { 0, 1, 2, 3 }")
+        return
+
+    # Text or binary trace, streamed a chunk at a time
+    bht = BHT(predictor_size, memory_size)
+    print(chunked_bp(read_trace_chunks(trace), predictor_size, bht))
+
+
+def write_test_trace(fileName: str, count: int, seed: int = 0) -> None:
+    # Loops of 8 iterations, each running a loop branch, a branch taken
+    # exactly when the loop branch was, and one of 16 branches taken 90% of
+    # the time
+    rng = random.Random(seed)
+    with open(fileName, "w") as file:
+        for branch in range(count):
+            iteration, slot = divmod(branch, 3)
+            if slot == 0:
+                taken = iteration % 8 != 7
+                file.write(f"400010 {int(taken)}\n")
+            elif slot == 1:
+                file.write(f"400020 {int(taken)}\n")
+            else:
+                file.write(f"{0x400030 + 4 * rng.randrange(16):x} {int(rng.random() < 0.9)}\n")
+        file.write("#eof\n")
+
+
+def list_bp(branches: list, predictor_size: int, memory_size: int) -> dict:
+    # The original list based predictors, for comparing against
+    if predictor_size == 0:
+        return static_bp(branches)
+    bht = BHT(predictor_size, memory_size)
+    if predictor_size == 1:
+        return one_bit_bp(branches, bht)
+    if predictor_size == 2:
+        return two_bit_bp(branches, bht)
+    return three_bit_bp(branches, bht)
+
+
+def test_trace_chunks():
+    with tempfile.TemporaryDirectory() as directory:
+        text = os.path.join(directory, "trace.txt")
+        binary = os.path.join(directory, "trace.btr")
+        write_test_trace(text, 5000)
+        # 777 branch chunks, so chunk boundaries fall mid-loop
+        assert write_binary_trace(binary, read_text_trace_chunks(text, 777)) == 5000
+        lengths = [len(addresses) for addresses, results in read_trace_chunks(binary)]
+        assert lengths == [777] * 6 + [338]
+
+        branches = read_trace(text)
+        for predictor_size in (0, 1, 2, 3):
+            for memory_size in (16, 100, 1024):
+                expected = list_bp(branches, predictor_size, memory_size)
+                for chunks in (
+                    read_trace_chunks(text),
+                    read_trace_chunks(text, 777),
+                    read_trace_chunks(binary),
+                ):
+                    bht = BHT(predictor_size, memory_size)
+                    assert chunked_bp(chunks, predictor_size, bht) == expected
+
+
+def test_sweep_bp():
+    with tempfile.TemporaryDirectory() as directory:
+        text = os.path.join(directory, "trace.txt")
+        write_test_trace(text, 5000)
+        branches = read_trace(text)
+        predictor_sizes, memory_sizes = [0, 1, 2, 3], [16, 100, 1024]
+
+        counters = [count_correct] if np is None else [count_correct, count_correct_np]
+        for counter in counters:
+            rows = sweep_bp(read_trace_chunks(text, 777), predictor_sizes, memory_sizes, counter)
+            assert [(row["predictor_size"], row["memory_size"]) for row in rows] == [
+                (predictor_size, memory_size)
+                for predictor_size in predictor_sizes
+                for memory_size in memory_sizes
+            ]
+            for row in rows:
+                expected = list_bp(branches, row["predictor_size"], row["memory_size"])
+                assert {key: row[key] for key in expected} == expected
+
+        csv_path = os.path.join(directory, "results.csv")
+        write_results_table(rows, csv_path)
+        with open(csv_path, newline="") as file:
+            read_rows = list(csv.DictReader(file))
+        assert read_rows == [{key: str(value) for key, value in row.items()} for row in rows]
+
+
+def random_test_branches(count: int, seed: int = 0) -> tuple:
+    # (addresses, results) for 512 branches with random biases
+    rng = random.Random(seed)
+    pcs = [rng.randrange(0x400000, 0x500000) for _ in range(512)]
+    bias = [rng.random() for _ in pcs]
+    addresses, results = array("Q"), array("B")
+    for _ in range(count):
+        which = rng.randrange(len(pcs))
+        addresses.append(pcs[which])
+        results.append(rng.random() < bias[which])
+    return addresses, results
+
+
+def split_chunks(addresses, results, chunk_size: int) -> list:
+    return [
+        (addresses[offset : offset + chunk_size], results[offset : offset + chunk_size])
+        for offset in range(0, len(addresses), chunk_size)
+    ]
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+def test_count_correct_np():
+    addresses, results = random_test_branches(5000)
+    branches = [
+        {"branch": f"{addr:x}", "result": str(result)} for addr, result in zip(addresses, results)
+    ]
+    for predictor_size in (0, 1, 2, 3):
+        for memory_size in (12, 96, 1000, 4096):
+            expected = list_bp(branches, predictor_size, memory_size)
+            for chunk_size in (1, 100, 4096, 1 << 20):
+                chunks = split_chunks(addresses, results, chunk_size)
+                scalar_bht = BHT(predictor_size, memory_size)
+                vector_bht = BHT(predictor_size, memory_size)
+                assert chunked_bp(chunks, predictor_size, scalar_bht, count_correct) == expected
+                assert chunked_bp(chunks, predictor_size, vector_bht, count_correct_np) == expected
+                assert list(vector_bht.arr) == scalar_bht.arr
+
+    # One full 1M branch chunk
+    addresses, results = random_test_branches(1 << 20, seed=1)
+    for predictor_size in (2, 3):
+        scalar_bht, vector_bht = BHT(predictor_size, 1000), BHT(predictor_size, 1000)
+        vector_correct = count_correct_np(addresses, results, predictor_size, vector_bht)
+        assert vector_correct == count_correct(addresses, results, predictor_size, scalar_bht)
+        assert list(vector_bht.arr) == scalar_bht.arr
+
+
+def test_correlating_predictors():
+    with tempfile.TemporaryDirectory() as directory:
+        text = os.path.join(directory, "trace.txt")
+        write_test_trace(text, 30000)
+        branches = read_trace(text)
+
+        # Bimodal predictors match the list based ones
+        for predictor_size in (1, 2, 3):
+            for memory_size in (16, 100, 1024):
+                rows = compare_bp(
+                    read_trace_chunks(text, 777),
+                    {"bimodal": BimodalPredictor(predictor_size, memory_size)},
+                )
+                expected = list_bp(branches, predictor_size, memory_size)
+                assert {key: rows[0][key] for key in expected} == expected
+
+        rows = {
+            row["predictor"]: row
+            for row in compare_bp(read_trace_chunks(text), standard_predictors(1024))
+        }
+        for name in ("gshare", "GAg", "tournament"):
+            assert rows[name]["correct"] > rows["two bit"]["correct"]
+
+    # Equal budgets, up to rounding table sizes to powers of two
+    for memory_size in (1024, 4096, 65536):
+        for predictor in standard_predictors(memory_size).values():
+            assert abs(predictor.storage_bits() - memory_size) <= memory_size * 0.05
+
+    # Branches alternating on one address: the 1 bit predictor is always
+    # wrong and the 1 bit history GAg learns the pattern, so the chooser,
+    # trained from the predictions predict() saved, moves to GAg
+    tournament = TournamentPredictor(BimodalPredictor(1, 16), GAgPredictor(2, 8, 1), 16)
+    branches_correct = 0
+    for branch in range(100):
+        taken = branch % 2 == 0
+        if tournament.predict(0) == taken:
+            branches_correct += 1
+        tournament.update(0, taken)
+    assert branches_correct >= 95
+    assert tournament.chooser.arr[0] == 3
+
+
+def test_tage_perceptron():
+    with tempfile.TemporaryDirectory() as directory:
+        text = os.path.join(directory, "trace.txt")
+        write_test_trace(text, 30000)
+        predictors = standard_predictors(4096)
+        rows = {
+            row["predictor"]: row
+            for row in compare_bp(
+                read_trace_chunks(text),
+                {name: predictors[name] for name in ("two bit", "TAGE", "perceptron")},
+            )
+        }
+    assert rows["two bit"]["percentage"] < 90
+    assert rows["TAGE"]["percentage"] > 93
+    assert rows["perceptron"]["percentage"] > 95
+
+    # Base counters, 13 bits per tagged entry, 64 history bits and use-alt
+    assert TagePredictor(1024, 4, 10).storage_bits() == 512 * 2 + 4096 * 13 + 64 + 4
+    # 8 bit weights and the history
+    assert PerceptronPredictor(8, 8, 32).storage_bits() == 8 * 256 * 8 + 32
+
+    # Nothing is allocated yet, so no tagged entry may provide
+    tage = TagePredictor(1024, 4, 10)
+    for addr in range(0, 1 << 16, 16):
+        tage.predict(addr)
+        assert tage.provider == -1
+
+    for arguments in ({"tag_bits": 1}, {"tag_bits": 17}, {"table_bits": 0}):
+        try:
+            TagePredictor(1024, **arguments)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"TagePredictor accepted {arguments}")
+    for predictor_size in (0, 9):
+        try:
+            PackedBHT(predictor_size, 1024)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"PackedBHT accepted {predictor_size} bit counters")
+
+
+def test_sharded_bp():
+    with tempfile.TemporaryDirectory() as directory:
+        text = os.path.join(directory, "trace.txt")
+        addresses, results = random_test_branches(20000)
+        with open(text, "w") as file:
+            for addr, result in zip(addresses, results):
+                file.write(f"{addr:x} {result}\n")
+            file.write("#eof\n")
+
+        for predictor_size, memory_size in ((0, 64), (1, 64), (2, 64), (2, 1000), (3, 4096)):
+            expected = chunked_bp(
+                read_trace_chunks(text), predictor_size, BHT(predictor_size, memory_size)
+            )
+            for shards, warmup in ((4, 0), (4, 100), (7, 1000)):
+                result = sharded_bp(text, predictor_size, memory_size, shards, warmup)
+                assert result["checked"] == expected["checked"]
+                assert abs(result["correct"] - expected["correct"]) <= result["error_bound"]
+                if predictor_size == 2 and memory_size == 1000 and warmup == 0:
+                    assert result["error_bound"] > 0
+
+            # One shard, or a warm-up reaching the trace start, is exact
+            for shards, warmup in ((1, 0), (4, 20000)):
+                result = sharded_bp(text, predictor_size, memory_size, shards, warmup)
+                assert result["error_bound"] == 0
+                assert {key: result[key] for key in expected} == expected
 
 
-main()
+if __name__ == "__main__":
+    main()